@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+"""
+Benchmarks for reading and writing datasets.
+
+The benchmarks are optional and not part of the test suite; they only
+print timings and make no assertions. Run all of them with
+`python benchmarks.py` or select some of them by name, e.g.
+`python benchmarks.py hash`. The spectroscopy package has to be
+installed or on the PYTHONPATH.
+"""
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from spectroscopy.class_factory import _update_hash, _to_datetime64
+from spectroscopy.dataset import Dataset
+from spectroscopy.datamodel import (RawDataBuffer, ConcentrationBuffer,
+                                    TargetBuffer)
+from spectroscopy.plugins.flyspec import read_spectra
+from spectroscopy.util import parse_iso_8601, nearest_index, bearing2vec
+
+
+def timeit(func, repeat=3):
+    """
+    Return the best wall clock time of several runs of func.
+    """
+    best = np.inf
+    for i in range(repeat):
+        t0 = time.time()
+        func()
+        best = min(best, time.time() - t0)
+    return best
+
+
+def report(name, nops, seconds, unit='ops'):
+    print('{:<40s} {:>12.1f} {:s}/s ({:.3f} s)'.format(
+        name, nops/seconds, unit, seconds))
+
+
+def bench_append(nappend=2000):
+    """
+    Cost of appending single spectra to an extendable element with and
+    without write-behind buffering.
+    """
+    buffers = [RawDataBuffer(d_var=np.random.rand(1, 2048),
+                             datetime=[np.datetime64('2017-01-10T15:23:00') +
+                                       np.timedelta64(i, 's')])
+               for i in range(nappend)]
+    for name, write_behind in (('append', None),
+                               ('append write-behind', {'rows': 500})):
+        def append():
+            d = Dataset(tempfile.mktemp(), 'w', write_behind=write_behind)
+            r = d.new(RawDataBuffer(d_var=np.zeros((1, 2048)),
+                                    ind_var=np.arange(2048.),
+                                    datetime=['2017-01-10T15:22:59']))
+            for b in buffers:
+                r.append(b)
+            d.close()
+
+        report(name, nappend, timeit(append))
+
+
+def bench_hash(shapes=((1, 482), (10, 482), (100, 2048)), ninserts=50):
+    """
+    Hashing of array payloads and insert throughput of spectra. Note that
+    numpy truncates the text representation of arrays with more than 1000
+    elements so for those the text hash only covers a few values.
+    """
+    rng = np.random.RandomState(42)
+    for shape in shapes:
+        spectra = [rng.rand(*shape) for i in range(ninserts)]
+        label = '{:d}x{:d}'.format(*shape)
+
+        def text_hash():
+            for _s in spectra:
+                s = hashlib.sha224()
+                s.update('{}'.format(_s).encode('ascii'))
+                s.digest()
+
+        def bytes_hash():
+            for _s in spectra:
+                s = hashlib.sha224()
+                _update_hash(s, 'd_var', _s)
+                s.digest()
+
+        report('hash {:s} (text)'.format(label), ninserts,
+               timeit(text_hash))
+        report('hash {:s} (bytes)'.format(label), ninserts,
+               timeit(bytes_hash))
+
+        wavelengths = np.arange(shape[1])
+        buffers = [RawDataBuffer(d_var=_s, ind_var=wavelengths)
+                   for _s in spectra]
+
+        def insert():
+            d = Dataset(tempfile.mktemp(), 'w')
+            for rb in buffers:
+                d.new(rb, pedantic=True)
+            d.close()
+
+        report('insert {:s} (pedantic)'.format(label), ninserts,
+               timeit(insert))
+
+
+def bench_insert(nrows=(1, 10, 100, 1000), ninserts=20):
+    """
+    Insert throughput of raw data elements holding blocks of 2048 channel
+    float64 spectra with a timestamp per spectrum. The chunkshape of the
+    spectra is sized from the first block that is written.
+    """
+    rng = np.random.RandomState(42)
+    start = np.datetime64('2017-01-10T15:23:00')
+    for n in nrows:
+        times = start + np.arange(n)*np.timedelta64(1, 's')
+        buffers = [RawDataBuffer(d_var=rng.rand(n, 2048),
+                                 ind_var=np.arange(2048.),
+                                 datetime=times)
+                   for i in range(ninserts)]
+        chunkshape = []
+
+        def insert():
+            d = Dataset(tempfile.mktemp(), 'w')
+            for rb in buffers:
+                r = d.new(rb, pedantic=True)
+            d._f.flush()
+            chunkshape[:] = [r._root.d_var.chunkshape]
+            d.close()
+
+        seconds = timeit(insert, repeat=5)
+        report('insert {:d}x2048 chunks {}'.format(n, chunkshape[0]),
+               ninserts, seconds, unit='inserts')
+
+
+def bench_new_many(nelements=10000):
+    """
+    Element creation throughput for many small elements.
+    """
+    buffers = []
+    for i in range(nelements):
+        buffers.append(ConcentrationBuffer(value=np.random.rand(5),
+                                           gas_species='SO2',
+                                           unit='ppm m'))
+
+    def new():
+        d = Dataset(tempfile.mktemp(), 'w')
+        for cb in buffers:
+            d.new(cb)
+        d.close()
+
+    def new_many():
+        d = Dataset(tempfile.mktemp(), 'w')
+        d.new_many(buffers)
+        d.close()
+
+    report('new {:d} elements'.format(nelements), nelements,
+           timeit(new, repeat=1))
+    report('new_many {:d} elements'.format(nelements), nelements,
+           timeit(new_many, repeat=1))
+
+
+def bench_views(nrows=1000, naccess=10000):
+    """
+    Cost of accessing array properties and reading single spectra from them.
+    """
+    d = Dataset(tempfile.mktemp(), 'w')
+    r = d.new(RawDataBuffer(d_var=np.random.rand(nrows, 2048),
+                            ind_var=np.arange(2048.)))
+
+    def access():
+        for i in range(naccess):
+            r.d_var
+
+    def shape():
+        for i in range(naccess):
+            r.d_var.shape
+
+    def row():
+        for i in range(naccess):
+            r.d_var[i % nrows]
+
+    report('array property access', naccess, timeit(access))
+    report('array property shape', naccess, timeit(shape))
+    report('array property single row', naccess, timeit(row))
+    d.close()
+
+
+def bench_datetime(ntimes=86400):
+    """
+    Conversion of a day of 1 s timestamps as assigned to a buffer, compared
+    to parsing every timestamp on its own.
+    """
+    t0 = np.datetime64('2017-01-10T00:00:00', 'ms')
+    times = t0 + np.arange(ntimes) * np.timedelta64(1, 's')
+    strings = [str(t) for t in times]
+    basic = [parse_iso_8601(t).strftime('%Y%m%dT%H%M%S') for t in strings]
+
+    def scalar():
+        np.array([parse_iso_8601(t).isoformat() for t in strings],
+                 dtype='datetime64[ms]')
+
+    report('datetime strings (scalar parser)', ntimes, timeit(scalar))
+    report('datetime strings', ntimes,
+           timeit(lambda: _to_datetime64(strings)))
+    report('datetime64', ntimes, timeit(lambda: _to_datetime64(times)))
+    report('datetime basic format (fallback)', ntimes,
+           timeit(lambda: _to_datetime64(basic), repeat=1))
+
+
+def bench_buffers(nbuffers=20000):
+    """
+    Creation of many small buffers, e.g. one per scan, and their size in
+    memory.
+    """
+    values = np.random.rand(5)
+
+    def create():
+        for i in range(nbuffers):
+            ConcentrationBuffer(value=values, gas_species='SO2',
+                                unit='ppm m')
+
+    def assign():
+        cb = ConcentrationBuffer()
+        for i in range(nbuffers):
+            cb.gas_species = 'SO2'
+            cb.unit = 'ppm m'
+
+    report('buffer creation', nbuffers, timeit(create))
+    report('buffer attribute assignment', 2*nbuffers, timeit(assign))
+    tracemalloc.start()
+    buffers = [ConcentrationBuffer() for i in range(nbuffers)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('{:<40s} {:>12.1f} bytes'.format('empty buffer size',
+                                            size/float(len(buffers))))
+
+
+def bench_references(nelements=5000):
+    """
+    Cost of opening a dataset and resolving references between elements.
+    """
+    fn = tempfile.mktemp()
+    d = Dataset(fn, 'w')
+    t = d.new(TargetBuffer(name='White Island main vent'))
+    d.new_many([RawDataBuffer(target=t, ind_var=np.arange(10.))
+                for i in range(nelements)])
+    d.close()
+
+    def open_all():
+        Dataset.open(fn).close()
+
+    def resolve():
+        d = Dataset.open(fn, lazy=True)
+        for r in d.elements['RawData']:
+            r.target
+        d.close()
+
+    report('open and instantiate elements', nelements + 1, timeit(open_all))
+    report('resolve references', nelements, timeit(resolve))
+
+
+def bench_merge(nelements=2000):
+    """
+    Throughput of merging datasets, e.g. daily files into an archive.
+    """
+    d = Dataset(tempfile.mktemp(), 'w')
+    t = d.new(TargetBuffer(name='White Island main vent'))
+    d.new_many([RawDataBuffer(target=t, d_var=np.random.rand(1, 482),
+                              ind_var=np.arange(482.))
+                for i in range(nelements)])
+
+    def merge():
+        archive = Dataset(tempfile.mktemp(), 'w')
+        archive += d
+        archive.close()
+
+    report('merge', nelements + 1, timeit(merge), unit='elements')
+    d.close()
+
+
+def bench_spectra(nspectra=262144, nchunk=4096):
+    """
+    Reading FlySpec binary spectra into buffers. The default writes a 2 GiB
+    synthetic file; spectra are written and read in chunks to keep memory
+    use bounded. The old struct.unpack loop is only timed on the first
+    chunk.
+    """
+    fn = tempfile.mktemp()
+    chunk = np.random.rand(nchunk, 2048).astype(np.float32)
+    with open(fn, 'wb') as fh:
+        for i in range(nspectra // nchunk):
+            chunk.tofile(fh)
+
+    def unpack():
+        with open(fn, 'rb') as fh:
+            raw_data = fh.read(nchunk * 2048 * 4)
+        counts = []
+        for i in range(0, len(raw_data), 2048 * 4):
+            counts.append(struct.unpack("2048f", raw_data[i:i+(2048 * 4)]))
+        RawDataBuffer(d_var=np.array(counts))
+
+    def mmap():
+        spectra = read_spectra(fn)
+        for i in range(0, spectra.shape[0], nchunk):
+            RawDataBuffer(d_var=spectra[i:i + nchunk])
+
+    report('spectra struct.unpack', nchunk, timeit(unpack, repeat=1),
+           unit='spectra')
+    report('spectra memmap', nspectra, timeit(mmap, repeat=1),
+           unit='spectra')
+    os.remove(fn)
+
+
+def bench_minidoas_raw(nlines=20000):
+    """
+    Time and peak memory of reading a MiniDOAS raw data file into buffers
+    compared to streaming it into a dataset in chunks.
+    """
+    fn = tempfile.mktemp()
+    line = ('SR,20170328,{:.3f},992,4.712,2000,1,153,' +
+            ','.join(['150'] * 482) + '\n')
+    with open(fn, 'w') as fh:
+        for i in range(nlines):
+            fh.write(line.format(32400. + i))
+    mb = os.path.getsize(fn) / 2.**20
+
+    def buffers():
+        d = Dataset(tempfile.mktemp(), 'w')
+        d.read(fn, 'minidoas-raw')
+        d.close()
+
+    def stream():
+        d = Dataset(tempfile.mktemp(), 'w')
+        d.read(fn, 'minidoas-raw', chunksize=1000)
+        d.close()
+
+    for name, func in (('minidoas raw buffers', buffers),
+                       ('minidoas raw streamed', stream)):
+        tracemalloc.start()
+        seconds = timeit(func, repeat=1)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report(name, mb, seconds, unit='MiB')
+        print('{:<40s} {:>12.1f} MiB'.format(name + ' peak memory',
+                                              peak / 2.**20))
+    os.remove(fn)
+
+
+def bench_wind(days=365, nloop=1440):
+    """
+    Reading a year of 1 minute MiniDOAS wind direction and speed files and
+    aligning their times. The old per-timestamp alignment loop is only
+    timed on the first day.
+    """
+    t0 = np.datetime64('2017-01-01T00:00:00')
+    times = t0 + np.arange(days * 1440) * np.timedelta64(1, 'm')
+    stamps = [t.item().strftime('%d/%m/%Y %H:%M:%S') for t in times]
+    fn_wd = tempfile.mktemp()
+    fn_ws = tempfile.mktemp()
+    for fn, header, values in ((fn_wd, 'Wind dir. (deg)',
+                                np.random.uniform(0, 360, times.size)),
+                               (fn_ws, 'Wind speed (m/s)',
+                                np.random.uniform(0, 20, times.size))):
+        with open(fn, 'w') as fh:
+            fh.write('Time\t{}\n'.format(header))
+            for i in range(times.size):
+                # drop some speeds so the files need aligning
+                if fn == fn_ws and i % 97 == 0:
+                    continue
+                fh.write('{}\t{:.1f}\n'.format(stamps[i], values[i]))
+
+    def read():
+        d = Dataset(tempfile.mktemp(), 'w')
+        d.read({'direction': fn_wd, 'speed': fn_ws}, 'minidoas-wind')
+        d.close()
+
+    t1 = times[:nloop]
+    t2 = times[np.arange(times.size) % 97 != 0]
+
+    def loop():
+        for i, _d in enumerate(t1):
+            tdiff = np.abs(_d - t2)
+            idx = np.argmin(tdiff)
+            if tdiff.astype('int').min() > 1:
+                continue
+
+    def align():
+        idx, within = nearest_index(times, t2,
+                                    tolerance=np.timedelta64(1, 's'))
+        bearing2vec(np.random.uniform(0, 360, within.sum()),
+                    np.random.uniform(0, 20, within.sum()))
+
+    report('wind read and align', times.size, timeit(read, repeat=1),
+           unit='lines')
+    report('wind align', times.size, timeit(align), unit='lines')
+    report('wind align loop (old)', nloop, timeit(loop, repeat=1),
+           unit='lines')
+    os.remove(fn_wd)
+    os.remove(fn_ws)
+
+
+benchmarks = {'append': bench_append,
+              'buffers': bench_buffers,
+              'datetime': bench_datetime,
+              'hash': bench_hash,
+              'insert': bench_insert,
+              'merge': bench_merge,
+              'minidoas_raw': bench_minidoas_raw,
+              'new_many': bench_new_many,
+              'references': bench_references,
+              'spectra': bench_spectra,
+              'views': bench_views,
+              'wind': bench_wind}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
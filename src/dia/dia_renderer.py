@@ -260,8 +260,10 @@ class MyPyRenderer(ObjRenderer):
         s += "\n\n"
         s += "class {0:s}Buffer(__{0:s}Buffer):\n".format(k.name)
         s += self.build_documentation(k)
+        s += "\n\t__slots__ = ()"
         s += "\n\n"
         s += "class _{0:s}(__{0:s}):\n\t'''\n\t'''\n".format(k.name)
+        s += "\t__slots__ = ()\n"
         d['code'] = s
         d['dependencies'] = dependencies
         return d
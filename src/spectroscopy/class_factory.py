@@ -1,11 +1,19 @@
 """
 Generate classes defined in the datamodel.
 """
+import bisect
 import collections
+import contextlib
 from copy import deepcopy
 import datetime
 import hashlib
+import heapq
 import inspect
+import operator
+import os
+import shutil
+import threading
+import time
 from uuid import uuid4
 import warnings
 import weakref
@@ -103,6 +111,13 @@ class ResourceIdentifier(object):
     >>> assert(id(ref_c.get_referred_object()) == obj_id)
 
 
+    The resource identifiers of the elements of a Dataset are created with
+    :meth:`ResourceIdentifier.for_element`. They don't use the global
+    dictionary above as copies of a dataset share element IDs. Instead,
+    the referred object is looked up in the
+    :class:`ElementRegistry` of the element's file and loaded from the
+    file if it hasn't been instantiated or has been garbage collected.
+
     ResourceIdentifiers are considered identical if the IDs are
     the same.
 
@@ -137,6 +152,9 @@ class ResourceIdentifier(object):
 
     def __init__(self, oid=None, prefix=None,
                  referred_object=None):
+        self._registry = None
+        self._element_class = None
+        self._tracked = True
         # Create a resource id if None is given and possibly use a prefix.
         if oid is None:
             self.fixed = False
@@ -154,6 +172,8 @@ class ResourceIdentifier(object):
         ResourceIdentifier.__resource_id_tracker[self.id] += 1
 
     def __del__(self):
+        if not getattr(self, '_tracked', True):
+            return
         if self.id not in ResourceIdentifier.__resource_id_tracker:
             return
         # Decrement the resource id counter.
@@ -175,7 +195,15 @@ class ResourceIdentifier(object):
         ID as this instance has an associate object.
 
         Will return None if no object could be found.
+
+        Identifiers of elements resolve the element through the registry of
+        its file instead.
         """
+        if getattr(self, '_registry', None) is not None:
+            registry = self._registry()
+            if registry is None:
+                return None
+            return registry.resolve(self.id, self._element_class)
         try:
             return ResourceIdentifier.__resource_id_weak_dict[self.id]
         except KeyError:
@@ -215,6 +243,30 @@ class ResourceIdentifier(object):
         ResourceIdentifier.__resource_id_weak_dict[self.id] = \
             referred_object
 
+    @classmethod
+    def for_element(cls, oid, registry, element_class):
+        """
+        Return the resource identifier of an element of a Dataset.
+
+        :type oid: str
+        :param oid: ID of the element.
+        :type registry: :class:`ElementRegistry`
+        :param registry: Registry of the file containing the element. It is
+            referenced weakly.
+        :type element_class: class
+        :param element_class: Class of the element used to load it if it
+            hasn't been instantiated.
+        """
+        # Not added to the global tracker as the element is looked up in
+        # its registry
+        ri = cls.__new__(cls)
+        ri.id = oid
+        ri._prefix = None
+        ri._registry = weakref.ref(registry)
+        ri._element_class = element_class
+        ri._tracked = False
+        return ri
+
     def copy(self):
         """
         Returns a copy of the ResourceIdentifier.
@@ -346,38 +398,1005 @@ class ResourceIdentifier(object):
         self._uuid = str(uuid4())
 
 
-class RetVal(object):
+class ArrayView(object):
     """
-    Wrapper to make tables.array.Array read only.
+    Read-only view of an array stored in an HDF5 file. Indexing and slicing
+    only read the requested part of the array from disk while
+    :func:`numpy.asarray` reads the whole array. Attributes not defined here
+    are looked up on the underlying :class:`tables.EArray`.
     """
+    __slots__ = ('_node',)
 
-    def __init__(self, wrapped_object):
-        self.__dict__['_wrapped_object'] = wrapped_object
-        attributes = dir(wrapped_object)
-        for attr in attributes:
-            if hasattr(self, attr):
-                continue
-            self.__dict__[attr] = attr
+    def __init__(self, node):
+        object.__setattr__(self, '_node', node)
 
     def __setitem__(self, key, value):
         raise AttributeError('Data type is read only.')
 
-    def __setslice__(self, i, j, value):
+    def __setattr__(self, key, value):
         raise AttributeError('Data type is read only.')
 
-    def __setattr__(self, key, value):
+    def __delattr__(self, key):
         raise AttributeError('Data type is read only.')
 
-    def __getattribute__(self, key):
-        if key in ['_wrapped_object', '__dict__', '__class__']:
-            return object.__getattribute__(self, key)
-        return getattr(self._wrapped_object, key)
+    def __getattr__(self, key):
+        return getattr(self._node, key)
 
     def __getitem__(self, key):
-        return self._wrapped_object.__getitem__(key)
+        return self._node[key]
+
+    def __array__(self, dtype=None, copy=None):
+        if copy is False:
+            raise ValueError('The array has to be read from disk, which '
+                             'always creates a copy.')
+        data = self._node.read()
+        if dtype is not None:
+            return data.astype(dtype, copy=False)
+        return data
+
+    def __len__(self):
+        return self._node.nrows
+
+    def __iter__(self):
+        return self._node.iterrows()
+
+    @property
+    def shape(self):
+        return self._node.shape
+
+    @property
+    def dtype(self):
+        return self._node.dtype
+
+    @property
+    def ndim(self):
+        return self._node.ndim
 
     def __str__(self):
-        return self._wrapped_object.__str__()
+        return self._node.__str__()
+
+    def __repr__(self):
+        return self._node.__repr__()
+
+
+class _FileIndex(object):
+    """
+    Base class for in-memory indexes and settings of an HDF5 file. They are
+    created once per open file and shared by all elements stored in it.
+    """
+    # Every subclass keeps its own dictionary of indexes.
+    _indexes = None
+    _create_lock = threading.Lock()
+
+    def __init__(self, h5file):
+        # Don't keep the file alive from within the index.
+        self._f = weakref.proxy(h5file)
+
+    @classmethod
+    def for_file(cls, h5file):
+        """
+        Return the index of the given file and create it if necessary.
+        """
+        indexes = cls.__dict__.get('_indexes')
+        if indexes is None:
+            indexes = weakref.WeakKeyDictionary()
+            cls._indexes = indexes
+        try:
+            return indexes[h5file]
+        except KeyError:
+            pass
+        with _FileIndex._create_lock:
+            # another thread may have been faster
+            index = indexes.get(h5file)
+            if index is None:
+                index = cls(h5file)
+                indexes[h5file] = index
+            return index
+
+    @staticmethod
+    def release(h5file):
+        """
+        Drop the indexes of all kinds of the given file, e.g. when it is
+        closed.
+        """
+        subclasses = list(_FileIndex.__subclasses__())
+        with _FileIndex._create_lock:
+            while subclasses:
+                cls = subclasses.pop()
+                subclasses.extend(cls.__subclasses__())
+                indexes = cls.__dict__.get('_indexes')
+                if indexes is not None:
+                    indexes.pop(h5file, None)
+
+
+class TagIndex(_FileIndex):
+    """
+    Index of the tags stored in an HDF5 file.
+
+    Tags are stored as one earray per tag under '/tags' containing the IDs
+    of all tagged elements. Removed entries leave empty rows that are
+    reused when elements are tagged again. The index keeps a sorted list of
+    IDs for every tag, the set of tags for every element, and the row of
+    every entry so that lookups, additions and removals don't need to scan
+    the earrays.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(TagIndex, self).__init__(h5file)
+        self._ids = {}
+        self._tags = collections.defaultdict(set)
+        self._rows = {}
+        self._free = {}
+        try:
+            tags = h5file.root.tags._v_children
+        except tables.NoSuchNodeError:
+            return
+        for tag in tags:
+            self._load(tag, tags[tag][:])
+
+    def _load(self, tag, entries):
+        ids = []
+        rows = {}
+        free = []
+        for i, entry in enumerate(entries):
+            if entry == b'':
+                free.append(i)
+                continue
+            rid = entry.decode('ascii')
+            rows[rid] = i
+            ids.append(rid)
+            self._tags[rid].add(tag)
+        ids.sort()
+        self._ids[tag] = ids
+        self._rows[tag] = rows
+        # Empty rows are kept in a heap and reused in ascending order
+        self._free[tag] = free
+
+    def __contains__(self, tag):
+        return tag in self._ids
+
+    def registered(self):
+        """
+        Return the names of all registered tags.
+        """
+        return list(self._ids.keys())
+
+    def register(self, tag):
+        """
+        Register a new tag.
+        """
+        if tag in self._ids:
+            msg = "Tag '{:s}' has already been registered".format(tag)
+            raise ValueError(msg)
+        try:
+            self._f.create_group('/', 'tags')
+        except tables.NodeError:
+            pass
+        try:
+            self._f.create_earray('/tags', tag,
+                                  tables.StringAtom(itemsize=60), (0,))
+        except tables.NodeError:
+            msg = "Tag '{:s}' has already been registered".format(tag)
+            raise ValueError(msg)
+        self._load(tag, [])
+
+    def ids(self, tag):
+        """
+        Return the sorted IDs of all elements with the given tag.
+        """
+        return list(self._ids.get(tag, []))
+
+    def tags(self, rid):
+        """
+        Return the tags of the element with the given ID.
+        """
+        return set(self._tags.get(rid, ()))
+
+    def has(self, rid, tag):
+        """
+        Check whether the element with the given ID has the given tag.
+        """
+        ids = self._ids.get(tag, [])
+        i = bisect.bisect_left(ids, rid)
+        return i < len(ids) and ids[i] == rid
+
+    def add(self, rid, tag):
+        """
+        Tag the element with the given ID.
+        """
+        if tag not in self._ids:
+            msg = "Tag {:s} has not been registered yet. "
+            msg += "Use the 'Dataset.register_tags' function first."
+            raise ValueError(msg.format(tag))
+        if self.has(rid, tag):
+            return
+        ea = self._f.root.tags._v_children[tag]
+        entry = np.array([rid], dtype='S60')
+        if len(self._free[tag]) > 0:
+            row = heapq.heappop(self._free[tag])
+            ea[row] = entry
+        else:
+            row = ea.nrows
+            ea.append(entry)
+        bisect.insort(self._ids[tag], rid)
+        self._rows[tag][rid] = row
+        self._tags[rid].add(tag)
+
+    def add_many(self, rids, tag):
+        """
+        Tag all elements with the given IDs. New entries are appended to
+        the earray of the tag in one go.
+        """
+        if tag not in self._ids:
+            msg = "Tag {:s} has not been registered yet. "
+            msg += "Use the 'Dataset.register_tags' function first."
+            raise ValueError(msg.format(tag))
+        rows = self._rows[tag]
+        rids = [rid for rid in collections.OrderedDict.fromkeys(rids)
+                if rid not in rows]
+        if len(rids) < 1:
+            return
+        ea = self._f.root.tags._v_children[tag]
+        start = ea.nrows
+        ea.append(np.array(rids, dtype='S60'))
+        for i, rid in enumerate(rids):
+            rows[rid] = start + i
+            self._tags[rid].add(tag)
+        self._ids[tag].extend(rids)
+        self._ids[tag].sort()
+
+    def remove(self, rid, tag):
+        """
+        Remove the tag from the element with the given ID. If no element
+        has the tag anymore, the tag is removed from the file.
+        """
+        if not self.has(rid, tag):
+            return
+        ids = self._ids[tag]
+        del ids[bisect.bisect_left(ids, rid)]
+        row = self._rows[tag].pop(rid)
+        self._tags[rid].discard(tag)
+        if len(self._tags[rid]) < 1:
+            del self._tags[rid]
+        if len(ids) < 1:
+            self._f.remove_node('/tags/' + tag)
+            del self._ids[tag]
+            del self._rows[tag]
+            del self._free[tag]
+            return
+        self._f.root.tags._v_children[tag][row] = np.array('', dtype='S60')
+        heapq.heappush(self._free[tag], row)
+
+
+class HashIndex(_FileIndex):
+    """
+    Set of the content hashes stored in '/hash' of an HDF5 file. It is
+    used to detect duplicate entries without scanning the whole earray.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(HashIndex, self).__init__(h5file)
+        try:
+            self._hashes = set(h5file.root.hash[:])
+        except tables.NoSuchNodeError:
+            self._hashes = set()
+        self._pending = []
+        self._deferred = 0
+
+    @staticmethod
+    def _key(h):
+        # numpy strips trailing null bytes when reading fixed-length
+        # strings so digests are compared without them
+        return h.rstrip(b'\x00')
+
+    def __contains__(self, h):
+        return self._key(h) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def add(self, h, pedantic=False, defer=False):
+        """
+        Add a hash to the file. If `pedantic` is True, a ValueError is
+        raised if the hash already exists. If `defer` is True, the hash is
+        only written with the next call to :meth:`flush`.
+        """
+        if pedantic and h in self:
+            msg = "You can't add the same dataset "
+            msg += "more than once if 'pedantic=True'."
+            raise ValueError(msg)
+        self._pending.append(h)
+        self._hashes.add(self._key(h))
+        if self._deferred < 1 and not defer:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all pending hashes to the file.
+        """
+        if len(self._pending) > 0:
+            self._f.root.hash.append(np.array(self._pending, dtype='S28'))
+            self._pending = []
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """
+        Context manager to collect new hashes in memory and write them to
+        the file in one go when the context exits.
+        """
+        self._deferred += 1
+        try:
+            yield self
+        finally:
+            self._deferred -= 1
+            if self._deferred < 1:
+                self.flush()
+
+
+class ElementRegistry(_FileIndex):
+    """
+    Registry of the elements of an HDF5 file that have been instantiated,
+    keyed by their ID. Elements are referenced weakly. References between
+    elements are resolved through the registry of their file, loading
+    elements that haven't been instantiated yet. Access is thread-safe.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(ElementRegistry, self).__init__(h5file)
+        self._elements = weakref.WeakValueDictionary()
+        self._lock = threading.RLock()
+        self._pending = None
+
+    def __len__(self):
+        return len(self._elements)
+
+    def register(self, e):
+        """
+        Register an element.
+        """
+        rid = e._root._v_name
+        with self._lock:
+            if self._pending is not None:
+                self._pending[rid] = e
+            else:
+                self._elements[rid] = e
+
+    def get(self, rid):
+        """
+        Return the element with the given ID or None if it hasn't been
+        instantiated.
+        """
+        e = self._elements.get(rid)
+        pending = self._pending
+        if e is None and pending is not None:
+            e = pending.get(rid)
+        return e
+
+    def resolve(self, rid, cls):
+        """
+        Return the element with the given ID and load it from the group of
+        its class if it hasn't been instantiated yet. Returns None if there
+        is no such element.
+        """
+        e = self.get(rid)
+        if e is not None:
+            return e
+        with self._lock:
+            e = self.get(rid)
+            if e is None:
+                try:
+                    node = self._f.get_node('/' + cls.__name__.strip('_'),
+                                            rid)
+                except tables.NoSuchNodeError:
+                    return None
+                # registers itself
+                e = cls(node)
+        return e
+
+    def clear(self):
+        """
+        Remove all elements from the registry.
+        """
+        with self._lock:
+            self._elements.clear()
+
+    @contextlib.contextmanager
+    def deferred(self):
+        """
+        Context manager to register many new elements at once, e.g. when a
+        file is opened, instead of updating the weak dictionary for each
+        of them.
+        """
+        with self._lock:
+            nested = self._pending is not None
+            if not nested:
+                self._pending = {}
+        if nested:
+            yield self
+            return
+        try:
+            yield self
+        finally:
+            with self._lock:
+                pending, self._pending = self._pending, None
+                self._elements.update(pending)
+
+
+class Journal(_FileIndex):
+    """
+    Append-only journal of the rows written to extendable elements of an
+    HDF5 file while it is open for writing. Readers can follow the journal
+    with :class:`spectroscopy.dataset.JournalReader` while the file is
+    being written, without locks or copies of the file.
+
+    Every new extendable element and every call to its `append` method is
+    recorded with the element ID, its type and the written arrays. Records
+    are published in numbered segments, `.npz` files holding up to
+    `records` records, once a segment is full, once its oldest record is
+    older than `interval` seconds or when the journal is flushed, e.g. by
+    :meth:`Dataset.flush`. Segments are written to a temporary file first
+    and then renamed so readers never see partial segments.
+
+    The rows of published segments are also in the HDF5 file. Segments
+    older than `retain` seconds are removed once the HDF5 file has been
+    flushed to disk, so the journal doesn't keep a second copy of the
+    data; the file 'first' holds the number of the oldest segment left.
+    Each writer session uses its own directory whose name is published in
+    the file 'current' of the journal directory.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(Journal, self).__init__(h5file)
+        self.directory = None
+        self.records = 1
+        self.interval = None
+        self.retain = 600.
+        self._seq = 0
+        self._pending = []
+        self._since = None
+        # (number, publication time) of the segments not yet removed
+        self._published = collections.deque()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def path(filename):
+        """
+        Return the journal directory of an HDF5 file.
+        """
+        return filename + '.journal'
+
+    @property
+    def active(self):
+        return self.directory is not None
+
+    def start(self, records=1, interval=None, retain=600.):
+        """
+        Start a new session. Segments of previous sessions are removed.
+
+        :type records: int
+        :param records: Maximum number of records per segment.
+        :type interval: float
+        :param interval: Maximum time in seconds a record waits for its
+            segment to be published. If None, records wait until the
+            segment is full or the journal is flushed.
+        :type retain: float
+        :param retain: Time in seconds published segments are kept. If
+            None, segments are kept until the next session starts.
+        """
+        root = self.path(self._f.filename)
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                if os.path.isdir(os.path.join(root, name)):
+                    shutil.rmtree(os.path.join(root, name),
+                                  ignore_errors=True)
+        session = str(uuid4())
+        os.makedirs(os.path.join(root, session))
+        fn = os.path.join(root, 'current')
+        with open(fn + '.tmp', 'w') as fh:
+            fh.write(session)
+        os.replace(fn + '.tmp', fn)
+        with self._lock:
+            self.directory = os.path.join(root, session)
+            self.records = records
+            self.interval = interval
+            self.retain = retain
+            self._seq = 0
+            self._pending = []
+            self._published.clear()
+
+    def stop(self):
+        """
+        Publish the pending records and stop publishing segments.
+        Published segments are kept until the next session starts.
+        """
+        with self._lock:
+            self.flush()
+            self.directory = None
+
+    def write(self, e, arrays):
+        """
+        Record the arrays written to an element. Datetimes are given in
+        milliseconds since the epoch.
+        """
+        if self.directory is None:
+            return
+        data = {'__id__': np.array(e._root._v_name),
+                '__type__': np.array(str(e))}
+        for key, val in arrays.items():
+            val = np.asarray(val)
+            if e._properties[key][1] == datetime.datetime and \
+               val.dtype.kind == 'i':
+                val = val.astype(np.int64).view('datetime64[ms]')
+            data[key] = val
+        with self._lock:
+            if not self._pending:
+                self._since = time.time()
+            self._pending.append(data)
+            if len(self._pending) >= self.records or \
+                    (self.interval is not None and
+                     time.time() - self._since >= self.interval):
+                self.flush()
+
+    def flush(self):
+        """
+        Publish the pending records as a new segment and remove segments
+        older than `retain` seconds.
+        """
+        with self._lock:
+            if self.directory is None or not self._pending:
+                return
+            data = {}
+            for i, record in enumerate(self._pending):
+                for key, val in record.items():
+                    data['{:d}:{:s}'.format(i, key)] = val
+            fn = os.path.join(self.directory,
+                              '{:010d}.npz'.format(self._seq))
+            with open(fn + '.tmp', 'wb') as fh:
+                np.savez(fh, **data)
+            os.replace(fn + '.tmp', fn)
+            now = time.time()
+            self._published.append((self._seq, now))
+            self._seq += 1
+            self._pending = []
+            if self.retain is not None and \
+                    now - self._published[0][1] >= self.retain:
+                self._prune(now - self.retain)
+
+    def _prune(self, before):
+        """
+        Flush the HDF5 file and remove the segments published before the
+        given time.
+        """
+        self._f.flush()
+        removed = []
+        while self._published and self._published[0][1] <= before:
+            removed.append(self._published.popleft()[0])
+        if not removed:
+            return
+        # Readers learn where the journal starts before segments disappear
+        fn = os.path.join(self.directory, 'first')
+        with open(fn + '.tmp', 'w') as fh:
+            fh.write(str(removed[-1] + 1))
+        os.replace(fn + '.tmp', fn)
+        for seq in removed:
+            os.remove(os.path.join(self.directory,
+                                   '{:010d}.npz'.format(seq)))
+
+
+class WriteBehind(_FileIndex):
+    """
+    Write-behind buffer for the `append` method of extendable elements.
+    While it is enabled, appended rows are collected in memory per element
+    and written with one append per array when the element has collected
+    `rows` rows or `nbytes` bytes, when its oldest rows are older than
+    `interval` seconds, when one of its arrays is read or when the buffer
+    is flushed explicitly, e.g. by :meth:`Dataset.flush` or
+    :meth:`Dataset.close`. The interval is checked whenever rows are
+    appended.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(WriteBehind, self).__init__(h5file)
+        self.rows = None
+        self.nbytes = None
+        self.interval = None
+        self._pending = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.rows is not None or self.nbytes is not None or \
+            self.interval is not None
+
+    def configure(self, rows=None, nbytes=None, interval=None):
+        """
+        Set the limits after which buffered rows are written. The buffer
+        is disabled if all limits are None.
+        """
+        self.flush()
+        self.rows = rows
+        self.nbytes = nbytes
+        self.interval = interval
+
+    def add(self, e, arrays, digest, pedantic=False):
+        """
+        Buffer the arrays appended to an element.
+        """
+        with self._lock:
+            HashIndex.for_file(e._root._v_file).add(digest,
+                                                    pedantic=pedantic,
+                                                    defer=True)
+            rid = e._root._v_name
+            try:
+                pending = self._pending[rid]
+            except KeyError:
+                pending = {'element': e, 'arrays': {}, 'rows': 0,
+                           'nbytes': 0, 'since': time.time()}
+                self._pending[rid] = pending
+                object.__setattr__(e, '_write_behind', self)
+            nrows = 0
+            for key, val in arrays.items():
+                val = np.asarray(val)
+                pending['arrays'].setdefault(key, []).append(val)
+                pending['nbytes'] += val.nbytes
+                nrows = max(nrows, len(val))
+            pending['rows'] += nrows
+            due = [rid for rid, pending in self._pending.items()
+                   if self._due(pending)]
+            for rid in due:
+                self._flush(rid)
+            if len(due) > 0:
+                HashIndex.for_file(e._root._v_file).flush()
+
+    def _due(self, pending):
+        if self.rows is not None and pending['rows'] >= self.rows:
+            return True
+        if self.nbytes is not None and pending['nbytes'] >= self.nbytes:
+            return True
+        return self.interval is not None and \
+            time.time() - pending['since'] >= self.interval
+
+    def _flush(self, rid):
+        """
+        Write the buffered rows of an element. The rows are only removed
+        from the buffer once they have been written, so they are kept if
+        writing them raises an exception.
+        """
+        pending = self._pending[rid]
+        e = pending['element']
+        arrays = dict((key, np.concatenate(vals))
+                      for key, vals in pending['arrays'].items())
+        e._write_rows(arrays)
+        del self._pending[rid]
+        object.__setattr__(e, '_write_behind', None)
+
+    def flush(self, e=None):
+        """
+        Write the buffered rows of an element or of all elements.
+        """
+        with self._lock:
+            if e is None:
+                rids = list(self._pending)
+            elif e._root._v_name in self._pending:
+                rids = [e._root._v_name]
+            else:
+                return
+            if len(rids) < 1:
+                return
+            f = self._pending[rids[0]]['element']._root._v_file
+            for rid in rids:
+                self._flush(rid)
+            HashIndex.for_file(f).flush()
+
+
+class StorageOptions(_FileIndex):
+    """
+    Compression filters for the arrays of an HDF5 file. The default filters
+    are the ones of the file's root group; filters for individual
+    properties are stored as the root attribute 'property_filters'.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(StorageOptions, self).__init__(h5file)
+        self._property_filters = getattr(h5file.root._v_attrs,
+                                         'property_filters', {})
+
+    @property
+    def property_filters(self):
+        return dict(self._property_filters)
+
+    @property_filters.setter
+    def property_filters(self, value):
+        for key, filters in value.items():
+            if not isinstance(filters, tables.Filters):
+                msg = "Filters for {:s} have to be of type: {}"
+                raise ValueError(msg.format(key, tables.Filters))
+        self._property_filters = dict(value)
+        self._f.root._v_attrs.property_filters = self._property_filters
+
+    def filters(self, key):
+        """
+        Return the filters for the given property or None if the default
+        filters apply.
+        """
+        return self._property_filters.get(key, None)
+
+
+class AttributeIndex(_FileIndex):
+    """
+    In-memory index of the scalar properties and references of the
+    elements in an HDF5 file. The index of an element type is built from
+    the attributes of its groups when it is first needed and kept up to
+    date as new elements are written.
+    """
+    _indexes = weakref.WeakKeyDictionary()
+
+    def __init__(self, h5file):
+        super(AttributeIndex, self).__init__(h5file)
+        self._types = {}
+
+    @staticmethod
+    def _values(val):
+        if isinstance(val, np.ndarray):
+            vals = val.tolist()
+        else:
+            vals = [val]
+        for v in vals:
+            if isinstance(v, np.generic):
+                v = v.item()
+            if isinstance(v, bytes):
+                v = v.decode('ascii')
+            yield v
+
+    def _add(self, index, rid, attrs):
+        for key, val in attrs.items():
+            if key in ('creation_time', 'modification_time'):
+                continue
+            for v in self._values(val):
+                index[key][v].add(rid)
+
+    def loaded(self, etype):
+        return etype in self._types
+
+    def load(self, etype, ids):
+        """
+        Build the index of an element type from the elements with the
+        given IDs.
+        """
+        index = collections.defaultdict(lambda: collections.defaultdict(set))
+        for rid in ids:
+            attrs = self._f.get_node('/' + etype, rid)._v_attrs
+            self._add(index, rid, dict((key, attrs[key]) for key in
+                                       attrs._v_attrnamesuser))
+        self._types[etype] = index
+
+    def add(self, etype, rid, attrs):
+        """
+        Add a new element to the index if its type has been loaded.
+        """
+        if etype in self._types:
+            self._add(self._types[etype], rid, attrs)
+
+    def reset(self):
+        """
+        Drop the index of all element types so it is rebuilt on next use.
+        """
+        self._types = {}
+
+    def lookup(self, etype, key, value):
+        """
+        Return the IDs of all elements of a type for which the property
+        or reference `key` equals `value`.
+        """
+        try:
+            return set(self._types[etype][key].get(value, ()))
+        except KeyError:
+            return set()
+
+
+# Number of rows summarised by one entry of the block min/max summary of
+# datetime arrays
+_TIME_BLOCK = 4096
+
+
+def _datetime_ms(value):
+    """
+    Convert an ISO 8601 string, datetime object or numpy datetime into
+    milliseconds since the epoch.
+
+    >>> _datetime_ms('1970-01-01T00:00:01.5')
+    1500
+    """
+    if isinstance(value, (str, bytes)):
+        if isinstance(value, bytes):
+            value = value.decode('ascii')
+        value = spectroscopy.util.parse_iso_8601(value)
+    return int(np.datetime64(value, 'ms').astype(np.int64))
+
+
+def _update_time_summary(node, values):
+    """
+    Update the monotonicity flag and the block min/max summary of a
+    datetime earray after `values` (milliseconds since the epoch) have
+    been appended to it.
+    """
+    attrs = node._v_attrs
+    values = np.asarray(values, dtype=np.int64)
+    n0 = node.nrows - values.size
+    sorted_ = bool(np.all(values[1:] >= values[:-1]))
+    if n0 == 0:
+        bmin = np.zeros(0, dtype=np.int64)
+        bmax = np.zeros(0, dtype=np.int64)
+        monotonic = sorted_
+    else:
+        bmin = attrs.block_min
+        bmax = attrs.block_max
+        monotonic = bool(attrs.monotonic) and sorted_
+        if monotonic and values.size > 0:
+            # the maximum of the last block is the last value written
+            monotonic = bool(values[0] >= bmax[-1])
+    # fill up the last block before starting new ones
+    nfill = (-n0) % _TIME_BLOCK
+    head, rest = values[:nfill], values[nfill:]
+    if head.size > 0:
+        bmin[-1] = min(bmin[-1], head.min())
+        bmax[-1] = max(bmax[-1], head.max())
+    if rest.size > 0:
+        starts = np.arange(0, rest.size, _TIME_BLOCK)
+        bmin = np.append(bmin, np.minimum.reduceat(rest, starts))
+        bmax = np.append(bmax, np.maximum.reduceat(rest, starts))
+    attrs.monotonic = monotonic
+    attrs.block_min = bmin
+    attrs.block_max = bmax
+    _update_time_range(node._v_file, values)
+
+
+def _update_time_range(h5file, values):
+    """
+    Extend the time range of a file, stored as milliseconds since the
+    epoch in the root attribute 'time_range', to include `values`. Files
+    written by older versions don't have the attribute and are left alone.
+    """
+    attrs = h5file.root._v_attrs
+    values = np.asarray(values, dtype=np.int64)
+    if values.size < 1 or 'time_range' not in attrs:
+        return
+    trange = attrs.time_range
+    tmin = values.min()
+    tmax = values.max()
+    if trange.size == 2:
+        if trange[0] <= tmin and tmax <= trange[1]:
+            return
+        tmin = min(tmin, trange[0])
+        tmax = max(tmax, trange[1])
+    attrs.time_range = np.array([tmin, tmax], dtype=np.int64)
+
+
+def _append_datetimes(node, values):
+    """
+    Append datetimes to a datetime earray. Arrays are stored as
+    milliseconds since the epoch; files written by older versions store
+    ISO 8601 strings which are kept.
+    """
+    values = np.asarray(values)
+    if node.dtype.kind == 'S':
+        if values.dtype.kind != 'S':
+            values = np.datetime_as_string(
+                values.astype('datetime64[ms]')).astype('S')
+        node.append(values)
+        return
+    values = values.astype('datetime64[ms]').astype(np.int64)
+    node.append(values)
+    _update_time_summary(node, values)
+
+
+def _time_window(node, tmin=None, tmax=None, exclusive=False):
+    """
+    Return the rows of a datetime earray within [tmin, tmax], or within
+    (tmin, tmax) if exclusive is True. For arrays in chronological order
+    the window is found by bisecting the block summary and then the one or
+    two blocks containing its boundaries, and returned as a slice.
+    Otherwise only the blocks overlapping the window are read and the
+    matching row indices are returned as an array. The order of arrays
+    without a block summary is never assumed; they are read and compared
+    in full.
+    """
+    n = node.nrows
+    lo = _datetime_ms(tmin) if tmin is not None else None
+    hi = _datetime_ms(tmax) if tmax is not None else None
+    if exclusive:
+        # datetimes are compared as integer milliseconds
+        lo = lo + 1 if lo is not None else None
+        hi = hi - 1 if hi is not None else None
+    if node.dtype.kind == 'S' or 'monotonic' not in node._v_attrs:
+        # ISO 8601 strings written by older versions or arrays without a
+        # block summary, whose order is unknown
+        t = node[:]
+        if t.dtype.kind == 'S':
+            t = t.astype('datetime64[ms]').astype(np.int64)
+        mask = np.ones(n, dtype=bool)
+        if lo is not None:
+            mask &= t >= lo
+        if hi is not None:
+            mask &= t <= hi
+        return np.nonzero(mask)[0]
+    if n == 0:
+        return slice(0, 0)
+    bmin = node._v_attrs.block_min
+    bmax = node._v_attrs.block_max
+    bs = _TIME_BLOCK
+    if not node._v_attrs.monotonic:
+        candidates = np.ones(bmin.size, dtype=bool)
+        if lo is not None:
+            candidates &= bmax >= lo
+        if hi is not None:
+            candidates &= bmin <= hi
+        idx = []
+        for b in np.nonzero(candidates)[0]:
+            t = node[b*bs:(b+1)*bs]
+            mask = np.ones(t.size, dtype=bool)
+            if lo is not None:
+                mask &= t >= lo
+            if hi is not None:
+                mask &= t <= hi
+            idx.append(np.nonzero(mask)[0] + b*bs)
+        if len(idx) < 1:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(idx)
+    start = 0
+    stop = n
+    if lo is not None:
+        b = int(np.searchsorted(bmax, lo, side='left'))
+        if b >= bmax.size:
+            start = n
+        else:
+            t = node[b*bs:(b+1)*bs]
+            start = b*bs + int(np.searchsorted(t, lo, side='left'))
+    if hi is not None:
+        b = int(np.searchsorted(bmin, hi, side='right')) - 1
+        if b < 0:
+            stop = 0
+        else:
+            t = node[b*bs:(b+1)*bs]
+            stop = b*bs + int(np.searchsorted(t, hi, side='right'))
+    return slice(start, max(start, stop))
+
+
+def _chunkshape(shape, itemsize, extendable=False):
+    """
+    Return the chunkshape for an earray that grows along its first
+    dimension.
+
+    Chunks are sized from the data the array is created with. They hold
+    at most 128 KiB and the initial rows are split into chunks of equal
+    size so that the first write doesn't leave a large, mostly empty
+    chunk behind. Arrays of extendable elements get chunks of at least
+    128 KiB so that appending rows, e.g. spectra, stays efficient.
+
+    >>> _chunkshape((3,), 8)
+    (3,)
+    >>> _chunkshape((1, 2048), 8, extendable=True)
+    (8, 2048)
+    >>> _chunkshape((100, 2048), 8, extendable=True)
+    (8, 2048)
+    >>> _chunkshape((86400,), 8, extendable=True)
+    (14400,)
+    >>> _chunkshape((5000, 2048), 4)
+    (16, 2048)
+    """
+    rowbytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    maxrows = max(1, 128*1024 // rowbytes)
+    nrows = max(1, shape[0])
+    if extendable:
+        nrows = max(nrows, maxrows)
+    nchunks = -(-nrows // maxrows)
+    return (-(-nrows // nchunks),) + tuple(shape[1:])
 
 
 class H5Set(set):
@@ -389,44 +1408,17 @@ class H5Set(set):
         self.h5node = h5node
         # check for already existing tags e.g. when
         # reading in a file
-        f = self.h5node._v_file
-        try:
-            for _t in f.root.tags._v_children:
-                ea = f.root.tags._v_children[_t]
-                entries = ea[np.where(ea[:] == self.h5node._v_name.encode())]
-                if len(entries) > 0:
-                    super(H5Set, self).add(_t)
-        except (KeyError, tables.NoSuchNodeError):
-            pass
+        self._index = TagIndex.for_file(h5node._v_file)
+        super(H5Set, self).update(self._index.tags(h5node._v_name))
 
     def add(self, val):
         """
         Add an element to list of given tag.
         """
-        f = self.h5node._v_file
         if val in self:
             return
-        try:
-            super(H5Set, self).add(val)
-        except Exception as e:
-            print(val)
-            raise e
-        try:
-            ea = f.root.tags._v_children[val]
-        except (KeyError, tables.NoSuchNodeError):
-            msg = "Tag {:s} has not been registered yet. "
-            msg += "Use the 'Dataset.register_tags' function first."
-            raise ValueError(msg.format(val))
-        found = False
-        for i in range(ea.nrows):
-            if ea[i] == '':
-                ea[i] = np.array(
-                    self.h5node._v_name, dtype='S60')
-                found = True
-                break
-        if not found:
-            ea.append(
-                np.array([self.h5node._v_name], dtype='S60'))
+        self._index.add(self.h5node._v_name, val)
+        super(H5Set, self).add(val)
 
     def append(self, val):
         """
@@ -438,17 +1430,12 @@ class H5Set(set):
         """
         Remove element from list of given tag.
         """
-        f = self.h5node._v_file
         super(H5Set, self).remove(val)
-        ea = f.root.tags._v_children[val]
-        ea[np.where(ea[:] == self.h5node._v_name.encode())] = np.array(
-            [''], dtype='S60')
-        if np.all(ea[:] == np.array('', dtype='S60')):
-            f.remove_node('/tags/' + val)
+        self._index.remove(self.h5node._v_name, val)
 
     def pop(self):
         val = set.pop(self)
-        self.remove(val)
+        self._index.remove(self.h5node._v_name, val)
         return val
 
     def discard(self, val):
@@ -473,24 +1460,86 @@ class H5Set(set):
             self.discard(v)
 
 
+def _update_hash(s, key, val):
+    """
+    Add a property value to a content hash. Arrays are hashed from their
+    raw bytes together with their dtype and shape so they don't have to be
+    rendered as text.
+    """
+    s.update(key.encode('ascii'))
+    if isinstance(val, np.ndarray) and val.dtype.kind != 'O':
+        val = np.ascontiguousarray(val)
+        s.update('{}{}'.format(val.dtype.str, val.shape).encode('ascii'))
+        s.update(memoryview(val.reshape(-1).view(np.uint8)))
+    else:
+        s.update('{}'.format(val).encode('utf-8'))
+
+
+def _get_referred_element(h5node, rid, cls):
+    """
+    Return the element with the given ID. If it hasn't been instantiated
+    yet, e.g. because the file was opened lazily, load it from the file.
+    """
+    return ElementRegistry.for_file(h5node._v_file).resolve(rid, cls)
+
+
+def _to_datetime64(value):
+    """
+    Convert a sequence of datetimes into a datetime64[ms] array.
+    datetime64 arrays are only cast and ISO 8601 strings in extended
+    format are parsed by numpy in one go. Everything else, e.g. basic
+    format strings or timezone offsets, is parsed element by element with
+    :func:`spectroscopy.util.parse_iso_8601`.
+
+    >>> _to_datetime64(['2017-01-10T15:23:00', '2017-01-10 15:23:01.5Z'])
+    array(['2017-01-10T15:23:00.000', '2017-01-10T15:23:01.500'],
+          dtype='datetime64[ms]')
+    >>> _to_datetime64('2016-09-26T23:45:43+12:00')
+    array(['2016-09-26T11:45:43.000'], dtype='datetime64[ms]')
+    """
+    value = np.array(value, ndmin=1)
+    if value.dtype.kind == 'M':
+        return value.astype('datetime64[ms]')
+    if value.dtype.kind == 'S':
+        value = value.astype(np.str_)
+    if value.dtype.kind == 'U':
+        value = np.char.strip(value)
+        # a trailing 'Z' denotes UTC which is what datetime64 assumes
+        utc = np.char.endswith(value, 'Z')
+        if utc.any():
+            value = np.where(utc, np.char.rstrip(value, 'Z'), value)
+    try:
+        with warnings.catch_warnings():
+            # numpy only warns about timezone offsets and then ignores
+            # them
+            warnings.simplefilter('error', DeprecationWarning)
+            return value.astype('datetime64[ms]')
+    except (ValueError, TypeError, DeprecationWarning):
+        pass
+    _vals = []
+    for v in value.tolist():
+        if not isinstance(v, datetime.datetime):
+            v = spectroscopy.util.parse_iso_8601(str(v))
+        _vals.append(v)
+    return np.array(_vals, dtype='datetime64[ms]')
+
+
 def _buffer_property_factory(name, datatype, reference=False):
     """
-    Generate properties for a buffer class based on the datatype.
+    Generate properties for a buffer class based on the datatype. Returns
+    the property, which reads the value from the slot '_<name>', and the
+    function converting values before they are stored or None if values
+    are stored as they are.
     """
     # the private class attribute name
     attr_name = '_'+name
 
-    def setter(self, value):
-        self.__dict__[attr_name] = value
-    fset = setter
-
-    def getter(self):
-        return self.__dict__[attr_name]
-    fget = getter
+    fget = operator.attrgetter(attr_name)
+    convert = None
 
     if datatype[0] == np.ndarray:
         if reference:
-            def set_reference_array(self, value):
+            def convert(value):
                 if not isinstance(value, np.ndarray):
                     value = np.array(value, ndmin=1)
                 _t = []
@@ -500,141 +1549,105 @@ def _buffer_property_factory(name, datatype, reference=False):
                         msg = msg.format(name, datatype[1])
                         raise ValueError(msg)
                     _t.append(str(getattr(n, '_resource_id')).encode('ascii'))
-                self.__dict__[attr_name] = np.array(_t)
-            fset = set_reference_array
+                return np.array(_t)
 
         elif datatype[1] == datetime.datetime:
-            # if the array contains datetime we need to convert
-            # it into ascii byte strings as pytables can't handle datetime
-            # objects
-            def set_datetime_array(self, value):
-                if not isinstance(value, np.ndarray):
-                    value = np.array(value, ndmin=1).astype(np.str_)
-                _vals = []
-                for v in value:
-                    _vals.append((spectroscopy.util
-                                  .parse_iso_8601(v)
-                                  .isoformat().encode('ascii')))
-                    value = np.array(_vals)
-
-                self.__dict__[attr_name] = np.array(_vals)
-            fset = set_datetime_array
-
-            def get_datetime_array(self):
-                if self.__dict__[attr_name] is None:
-                    return None
-                dts = self.__dict__[attr_name]
-                _vals = []
-                for _dt in dts:
-                    _vals.append(_dt.decode('ascii'))
-                return np.array(_vals, dtype='datetime64[ms]')
-
-            fget = get_datetime_array
+            # datetimes are kept as datetime64[ms] and converted to
+            # milliseconds since the epoch when written to file
+            convert = _to_datetime64
 
         elif datatype[1] == np.str_:
             # strings are encoded into ascii byte strings
             # as this is how pytables stores strings
             # internally
-            def set_string_array(self, value):
-                if not isinstance(value, np.ndarray):
-                    value = np.array(value, ndmin=1).astype(np.str_)
-                _vals = []
-                for v in value:
-                    _vals.append(v.encode('ascii'))
-                self.__dict__[attr_name] = np.array(_vals)
-            fset = set_string_array
+            def convert(value):
+                value = np.array(value, ndmin=1)
+                if value.dtype.kind != 'S':
+                    value = value.astype(np.str_).astype(np.bytes_)
+                return value
 
             def get_string_array(self):
-                if self.__dict__[attr_name] is None:
+                value = getattr(self, attr_name)
+                if value is None:
                     return None
-                value = self.__dict__[attr_name]
-                _vals = []
-                for v in value:
-                    _vals.append(v.decode('ascii'))
-                return np.array(_vals)
+                return value.astype(np.str_)
             fget = get_string_array
 
         else:
-            def set_array(self, value):
-                self.__dict__[attr_name] = (np.array(value, ndmin=1).
-                                            astype(datatype[1]))
-            fset = set_array
+            def convert(value):
+                # a single copy, also for memory mapped arrays
+                return np.array(value, ndmin=1, dtype=datatype[1])
 
     else:
         if reference:
-            def set_reference(self, value):
-                if value is not None:
-                    if not isinstance(value, datatype[0]):
-                        msg = "{:s} has to be of type: {}"
-                        msg = msg.format(name, datatype[0])
-                        raise ValueError(msg)
-                    rid = str(getattr(value, '_resource_id')).encode('ascii')
-                else:
-                    rid = None
-                self.__dict__[attr_name] = rid
-            fset = set_reference
+            def convert(value):
+                if not isinstance(value, datatype[0]):
+                    msg = "{:s} has to be of type: {}"
+                    msg = msg.format(name, datatype[0])
+                    raise ValueError(msg)
+                return str(getattr(value, '_resource_id')).encode('ascii')
 
         elif datatype[0] == datetime.datetime:
-            def set_datetime(self, value):
+            def convert(value):
                 value = (spectroscopy.util
                          .parse_iso_8601(value)
                          .isoformat())
-                self.__dict__[attr_name] = np.array(value.encode('ascii'))
-            fset = set_datetime
+                return np.array(value.encode('ascii'))
 
             def get_datetime(self):
-                if self.__dict__[attr_name] is None:
+                dt = getattr(self, attr_name)
+                if dt is None:
                     return None
-                dt = self.__dict__[attr_name]
                 return dt.astype('datetime64[s]')
             fget = get_datetime
 
         elif datatype[0] == np.str_:
-            def set_string(self, value):
-                self.__dict__[attr_name] = value.encode('ascii')
-            fset = set_string
+            def convert(value):
+                return value.encode('ascii')
 
             def get_string(self):
-                if self.__dict__[attr_name] is None:
+                value = getattr(self, attr_name)
+                if value is None:
                     return None
-                return self.__dict__[attr_name].decode('ascii')
-
+                return value.decode('ascii')
             fget = get_string
 
-    return property(fget=fget, fset=fset)
+    return property(fget=fget), convert
 
 
 def _buffer_class_factory(class_name, class_properties=[],
                           class_references=[]):
     """
     Class factory for buffer classes. These contain staged data, that
-    can then be written to the HDF5 file.
+    can then be written to the HDF5 file. Values are kept in slots and
+    assignments are dispatched through a table of conversion functions.
     """
     cls_attrs = {}
+    converters = collections.OrderedDict()
     _properties = []
     # Assign class properties
     for item in class_properties:
-        cls_attrs[item[0]] = _buffer_property_factory(item[0], item[1])
+        cls_attrs[item[0]], converters[item[0]] = \
+            _buffer_property_factory(item[0], item[1])
         _properties.append(item[0])
     cls_attrs['_properties'] = _properties
 
     # Assign references to other elements in the datamodel
     _references = []
     for item in class_references:
-        cls_attrs[item[0]] = _buffer_property_factory(item[0], item[1],
-                                                      reference=True)
+        cls_attrs[item[0]], converters[item[0]] = \
+            _buffer_property_factory(item[0], item[1], reference=True)
         _references.append(item[0])
     cls_attrs['_references'] = _references
+    cls_attrs['__slots__'] = tuple('_'+key for key in converters)
 
     def __init__(self, **kwargs):
         # Set all property values to None or the kwarg value.
-        for key in self._properties:
+        for key, (slot, convert) in self._setters.items():
             value = kwargs.pop(key, None)
-            setattr(self, key, value)
-
-        for key in self._references:
-            value = kwargs.pop(key, None)
-            setattr(self, key, value)
+            if value is not None and convert is not None:
+                value = convert(value)
+            slot.__set__(self, value)
 
         if len(list(kwargs.keys())) > 0:
             msg = "The following names are not a "
@@ -643,26 +1656,42 @@ def _buffer_class_factory(class_name, class_properties=[],
             raise AttributeError(msg.format(type(self).__name__))
 
     def __setattr__(self, key, value):
-        prop = getattr(self.__class__, key, None)
-        if isinstance(prop, property):
-            if value is None:
-                attr_name = '_'+key
-                self.__dict__[attr_name] = None
-            else:
-                prop.fset(self, value)
-        else:
+        try:
+            slot, convert = self._setters[key]
+        except KeyError:
             raise AttributeError(
                     "%s is not an attribute or reference of class %s" %
                     (key, self.__class__.__name__))
+        if value is not None and convert is not None:
+            value = convert(value)
+        slot.__set__(self, value)
 
     def __str__(self):
         return class_name.strip('_')
 
+    def __getstate__(self):
+        # Buffers are handed between processes by Dataset.read_many
+        return dict((key, slot.__get__(self))
+                    for key, (slot, _) in self._setters.items())
+
+    def __setstate__(self, state):
+        # Values have already been converted when they were set
+        for key, (slot, _) in self._setters.items():
+            slot.__set__(self, state.get(key))
+
     cls_attrs['__init__'] = __init__
     cls_attrs['__setattr__'] = __setattr__
+    cls_attrs['__getstate__'] = __getstate__
+    cls_attrs['__setstate__'] = __setstate__
     cls_attrs['__str__'] = __str__
 
-    return type(class_name, (object,), cls_attrs)
+    cls = type(class_name, (object,), cls_attrs)
+    # Map every property to the descriptor of its slot and its conversion
+    # function
+    cls._setters = collections.OrderedDict(
+        (key, (cls.__dict__['_'+key], convert))
+        for key, convert in converters.items())
+    return cls
 
 
 def _base_property_factory(name, datatype, reference=False):
@@ -686,21 +1715,24 @@ def _base_property_factory(name, datatype, reference=False):
                     return None
                 _t = []
                 for val in value:
-                    _t.append((ResourceIdentifier(val.decode('ascii')).
-                               get_referred_object()))
+                    _t.append(_get_referred_element(
+                        self._root, val.decode('ascii'), datatype[1]))
                 return _t
             fget = get_reference_array
 
         elif datatype[1] == datetime.datetime:
-            # if the array contains datetime we need to convert
-            # it into ascii byte strings as pytables can't handle datetime
-            # objects
+            # datetime arrays are stored as milliseconds since the epoch
+            # as pytables can't handle datetime objects; older files
+            # contain ascii byte strings instead
             def get_datetime_array(self):
                 try:
                     dt = getattr(self._root, name)[:]
-                    return dt.astype('datetime64[ms]')
                 except tables.exceptions.NoSuchNodeError:
                     return None
+                if dt.dtype.kind == 'i':
+                    # milliseconds since the epoch
+                    return dt.view('datetime64[ms]')
+                return dt.astype('datetime64[ms]')
             fget = get_datetime_array
 
         elif datatype[1] == np.str_:
@@ -709,14 +1741,14 @@ def _base_property_factory(name, datatype, reference=False):
             # internally
             def get_string_array(self):
                 try:
-                    return RetVal(getattr(self._root, name))
+                    return ArrayView(getattr(self._root, name))
                 except tables.exceptions.NoSuchNodeError:
                     return None
             fget = get_string_array
         else:
             def get_array(self):
                 try:
-                    return RetVal(getattr(self._root, name))
+                    return ArrayView(getattr(self._root, name))
                 except tables.exceptions.NoSuchNodeError:
                     return None
             fget = get_array
@@ -728,8 +1760,8 @@ def _base_property_factory(name, datatype, reference=False):
                     value = self._root._v_attrs[name]
                 except KeyError:
                     return None
-                return (ResourceIdentifier(value.decode('ascii')).
-                        get_referred_object())
+                return _get_referred_element(
+                    self._root, value.decode('ascii'), datatype[0])
             fget = get_reference
 
         elif datatype[0] == datetime.datetime:
@@ -757,6 +1789,20 @@ def _base_property_factory(name, datatype, reference=False):
     return property(fget=fget)
 
 
+def _flush_before(prop):
+    """
+    Wrap an array property of an extendable element so that rows held in
+    a write-behind buffer are written before the array is read.
+    """
+    fget = prop.fget
+
+    def getter(self):
+        if self._write_behind is not None:
+            self._write_behind.flush(self)
+        return fget(self)
+    return property(fget=getter)
+
+
 def _base_class_factory(class_name, class_type='base', class_properties=[],
                         class_references=[]):
     """
@@ -781,27 +1827,40 @@ def _base_class_factory(class_name, class_type='base', class_properties=[],
                                                     reference=True)
         _references[item[0]] = item[1]
     cls_attrs['_references'] = _references
+    # Elements are referenced weakly by their ResourceIdentifier
+    cls_attrs['__slots__'] = ('_root', '_tags', '_resource_id',
+                              'creation_time', '__weakref__')
 
     def __init__(self, h5node, data_buffer=None, pedantic=False):
         # Set the parent HDF5 group after type checking
         if type(h5node) is not tables.group.Group:
             raise Exception("%s and %s are incompatible types." %
                             (type(h5node), tables.group.Group))
-        self.__dict__['_root'] = h5node
-        self.__dict__['_tags'] = H5Set(h5node)
-        # Every time a new object is created it gets a new resource ID
-        ri = ResourceIdentifier(oid=h5node._v_name, referred_object=self)
-        self.__dict__['_resource_id'] = ri
+        object.__setattr__(self, '_root', h5node)
+        object.__setattr__(self, '_tags', H5Set(h5node))
+        # Elements are registered with their file rather than globally so
+        # that datasets sharing element IDs, e.g. copies, don't interfere
+        registry = ElementRegistry.for_file(h5node._v_file)
+        ri = ResourceIdentifier.for_element(h5node._v_name, registry,
+                                            type(self))
+        object.__setattr__(self, '_resource_id', ri)
+        registry.register(self)
+        if class_type == 'extendable':
+            object.__setattr__(self, '_write_behind', None)
         if not hasattr(h5node._v_attrs, 'creation_time'):
-            self.__dict__['creation_time'] = \
-                    datetime.datetime.utcnow().isoformat()
+            object.__setattr__(self, 'creation_time',
+                               datetime.datetime.utcnow().isoformat())
             h5node._v_attrs.creation_time = self.creation_time
         else:
-            self.__dict__['creation_time'] = h5node._v_attrs.creation_time
+            object.__setattr__(self, 'creation_time',
+                               h5node._v_attrs.creation_time)
 
         if data_buffer is not None:
             f = h5node._v_file
+            options = StorageOptions.for_file(f)
             s = hashlib.sha224()
+            attrs = {}
+            arrays = {}
             for key, prop_type in self._properties.items():
                 private_key = '_'+key
                 val = getattr(data_buffer, private_key)
@@ -811,37 +1870,48 @@ def _base_class_factory(class_name, class_type='base', class_properties=[],
                     for _v in val:
                         self._tags.add(_v)
                     continue
-                tohash = '{}'.format(val)
-                s.update(tohash.encode('ascii'))
+                _update_hash(s, key, val)
                 if prop_type[0] == np.ndarray:
+                    if prop_type[1] == datetime.datetime:
+                        val = np.asarray(val).astype('datetime64[ms]')\
+                            .astype(np.int64)
                     try:
                         shape = list(val.shape)
+                        chunkshape = _chunkshape(shape, val.dtype.itemsize,
+                                                 hasattr(self, 'append'))
                         shape[0] = 0
                         at = tables.Atom.from_dtype(val.dtype)
                         vl = f.create_earray(h5node, key,
                                              atom=at,
-                                             shape=tuple(shape))
+                                             shape=tuple(shape),
+                                             filters=options.filters(key),
+                                             chunkshape=chunkshape)
                     except Exception as e:
                         print(val.dtype.type)
                         raise e
                     vl.append(val)
+                    if prop_type[1] == datetime.datetime:
+                        _update_time_summary(vl, val)
+                    arrays[key] = val
                 else:
                     h5node._v_attrs[key] = val
+                    attrs[key] = val
             for key in self._references.keys():
                 private_key = '_'+key
                 val = getattr(data_buffer, private_key)
-                h5node._v_attrs[key] = val
+                if val is not None:
+                    h5node._v_attrs[key] = val
+                    attrs[key] = val
             # Add a hash column to be able to avoid adding the same
-            # entries more than once
-            h = s.digest()
-            ea = f.root.hash
-            if pedantic:
-                for i in range(ea.nrows):
-                    if (h == ea[i]):
-                        msg = "You can't add the same dataset "
-                        msg += "more than once if 'pedantic=True'."
-                        raise ValueError(msg)
-            ea.append(np.array([h], dtype='S28'))
+            # entries more than once. The element keeps its own hash so
+            # that duplicates can also be detected when merging datasets.
+            h5node._v_attrs.content_hash = s.hexdigest()
+            HashIndex.for_file(f).add(s.digest(), pedantic=pedantic)
+            AttributeIndex.for_file(f).add(class_name.strip('_'),
+                                           h5node._v_name, attrs)
+            journal = Journal.for_file(f)
+            if journal.active and hasattr(self, 'append'):
+                journal.write(self, arrays)
 
     def __str__(self):
         return class_name.strip('_')
@@ -877,30 +1947,45 @@ def _base_class_factory(class_name, class_type='base', class_properties=[],
     if class_type == 'extendable':
         def append(self, databuffer, pedantic=False):
             s = hashlib.sha224()
+            arrays = {}
             for key, prop_type in self._properties.items():
                 private_key = '_'+key
                 val = getattr(databuffer, private_key)
                 if val is None:
                     continue
-                tohash = '{}'.format(val)
-                s.update(tohash.encode('ascii'))
+                _update_hash(s, key, val)
                 if prop_type[0] != np.ndarray:
                     continue
-                vl = getattr(self._root, key)
-                vl.append(val)
-            h = s.digest()
+                arrays[key] = val
+            object.__setattr__(self, 'modification_time',
+                               datetime.datetime.utcnow().isoformat())
             f = self._root._v_file
-            ea = f.root.hash
-            if pedantic:
-                for i in range(ea.nrows):
-                    if (h == ea[i]):
-                        msg = "You can't add the same dataset "
-                        msg += "more than once if 'pedantic=True'."
-                        raise ValueError(msg)
-            ea.append(np.array([h], dtype='S28'))
-            self.__dict__['modification_time'] = \
-                datetime.datetime.utcnow().isoformat()
-            self._root._v_attrs.modification_time = self.modification_time
+            wb = WriteBehind.for_file(f)
+            if wb.enabled:
+                wb.add(self, arrays, s.digest(), pedantic=pedantic)
+                return
+            # the rows are written even if the hash is a duplicate
+            self._write_rows(arrays)
+            HashIndex.for_file(f).add(s.digest(), pedantic=pedantic)
+
+        def _write_rows(self, arrays):
+            attrs = self._root._v_attrs
+            # the content hash covers the appended rows so that merging
+            # doesn't mistake the element for one without them
+            h = getattr(attrs, 'content_hash', None)
+            s = hashlib.sha224(bytes.fromhex(h)) if h is not None else None
+            for key, val in arrays.items():
+                vl = getattr(self._root, key)
+                if self._properties[key][1] == datetime.datetime:
+                    _append_datetimes(vl, val)
+                else:
+                    vl.append(val)
+                if s is not None:
+                    _update_hash(s, key, val)
+            Journal.for_file(self._root._v_file).write(self, arrays)
+            if s is not None:
+                attrs.content_hash = s.hexdigest()
+            attrs.modification_time = self.modification_time
 
         def __repr__(self):
             msg = ''
@@ -924,6 +2009,12 @@ def _base_class_factory(class_name, class_type='base', class_properties=[],
             return msg
 
         cls_attrs['append'] = append
+        cls_attrs['_write_rows'] = _write_rows
         cls_attrs['__repr__'] = __repr__
+        cls_attrs['__slots__'] += ('modification_time', '_write_behind')
+        # rows held in a write-behind buffer are written before reading
+        for key, datatype in _properties.items():
+            if datatype[0] == np.ndarray:
+                cls_attrs[key] = _flush_before(cls_attrs[key])
 
     return type(class_name, (object,), cls_attrs)
@@ -48,10 +48,12 @@ class InstrumentBuffer(__InstrumentBuffer):
 	:type description: str
 	:param description: Any additional information on the instrument that may be relevant.
 	'''
+	__slots__ = ()
 
 class _Instrument(__Instrument):
 	'''
 	'''
+	__slots__ = ()
 
 
 __Target = _base_class_factory('__Target', 'base',
@@ -95,10 +97,12 @@ class TargetBuffer(__TargetBuffer):
 	:param description: Any additional information on the plume that may be relevant.
 
 	'''
+	__slots__ = ()
 
 class _Target(__Target):
 	'''
 	'''
+	__slots__ = ()
 
 
 __RawDataType = _base_class_factory('__RawDataType', 'base',
@@ -137,10 +141,12 @@ class RawDataTypeBuffer(__RawDataTypeBuffer):
 	:type acquisition: str
 	:param acquisition: The type of acquisition (e.g. mobile, stationary)
 	'''
+	__slots__ = ()
 
 class _RawDataType(__RawDataType):
 	'''
 	'''
+	__slots__ = ()
 
 
 __DataQualityType = _base_class_factory('__DataQualityType', 'base',
@@ -171,10 +177,12 @@ class DataQualityTypeBuffer(__DataQualityTypeBuffer):
 	:type reference: str
 	:param reference: Reference to more detailed description
 	'''
+	__slots__ = ()
 
 class _DataQualityType(__DataQualityType):
 	'''
 	'''
+	__slots__ = ()
 
 
 __RawData = _base_class_factory('__RawData', 'extendable',
@@ -278,10 +286,12 @@ class RawDataBuffer(__RawDataBuffer):
 	:type user_notes: str
 	:param user_notes: Any additional information relevant to the measurements.
 	'''
+	__slots__ = ()
 
 class _RawData(__RawData):
 	'''
 	'''
+	__slots__ = ()
 
 
 __Method = _base_class_factory('__Method', 'extendable',
@@ -320,10 +330,12 @@ class MethodBuffer(__MethodBuffer):
 	:type reference: str
 	:param reference: URI  to more detailed method description.
 	'''
+	__slots__ = ()
 
 class _Method(__Method):
 	'''
 	'''
+	__slots__ = ()
 
 
 __GasFlow = _base_class_factory('__GasFlow', 'base',
@@ -410,10 +422,12 @@ class GasFlowBuffer(__GasFlowBuffer):
 	:type user_notes: str
 	:param user_notes: Any additional information that may be relevant.
 	'''
+	__slots__ = ()
 
 class _GasFlow(__GasFlow):
 	'''
 	'''
+	__slots__ = ()
 
 
 __Concentration = _base_class_factory('__Concentration', 'extendable',
@@ -480,10 +494,12 @@ class ConcentrationBuffer(__ConcentrationBuffer):
 	:type user_notes: str
 	:param user_notes: Any additional information that may be relevant.
 	'''
+	__slots__ = ()
 
 class _Concentration(__Concentration):
 	'''
 	'''
+	__slots__ = ()
 
 
 __Flux = _base_class_factory('__Flux', 'base',
@@ -546,10 +562,12 @@ class FluxBuffer(__FluxBuffer):
 	:type user_notes: str
 	:param user_notes: Any additional information that may be relevant.
 	'''
+	__slots__ = ()
 
 class _Flux(__Flux):
 	'''
 	'''
+	__slots__ = ()
 
 
 __PreferredFlux = _base_class_factory('__PreferredFlux', 'base',
@@ -600,10 +618,12 @@ class PreferredFluxBuffer(__PreferredFluxBuffer):
 	:type user_notes: str
 	:param user_notes: Comments relevant for reproducing preferred fluxes
 	'''
+	__slots__ = ()
 
 class _PreferredFlux(__PreferredFlux):
 	'''
 	'''
+	__slots__ = ()
 
 
 all_classes = [_Instrument, _Target, _RawDataType, _DataQualityType, _RawData, _Method, _GasFlow, _Concentration, _Flux, _PreferredFlux]
@@ -1,18 +1,237 @@
 """
 Provide container class for gas chemistry data.
 """
-import hashlib
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import datetime
+import json
+import os
+import re
+import threading
+import time
+from uuid import uuid4
 import warnings
 
 import numpy as np
 import tables
 from tables.exceptions import NoSuchNodeError, NodeError
 
-from spectroscopy.class_factory import ResourceIdentifier
+from spectroscopy.class_factory import (TagIndex, HashIndex, StorageOptions,
+                                        AttributeIndex, ElementRegistry,
+                                        Journal, WriteBehind, _FileIndex,
+                                        _chunkshape, _datetime_ms,
+                                        _time_window, _to_datetime64,
+                                        _update_time_range)
 from spectroscopy.plugins import get_registered_plugins
 from spectroscopy import datamodel
 
 
+class _IDRecord(tables.IsDescription):
+    """
+    Row of the ID lookup table.
+    """
+    id = tables.StringCol(60)
+    path = tables.StringCol(128)
+
+
+_query_clause = re.compile(r"^\s*([\w.]+)\s*==\s*(['\"])(.*)\2\s*$")
+
+
+def _read_file(ftype, filename, kwargs):
+    """
+    Parse a single file with the plugin for `ftype` without a dataset.
+    Runs in a worker process of :meth:`Dataset.read_many`, so exceptions
+    are returned rather than raised to keep them tied to their file.
+    """
+    try:
+        pg = get_registered_plugins()[ftype.lower()]()
+        return pg.read(None, filename, **kwargs)
+    except Exception as e:
+        return e
+
+
+class ElementList(object):
+    """
+    List of all elements of one type in a dataset. Elements are only
+    instantiated when they are first accessed.
+
+    :type cls: class
+    :param cls: The base class of the elements.
+    :type h5file: :class:`tables.File`
+    :param h5file: The HDF5 file containing the elements.
+    :type ids: list
+    :param ids: IDs of the elements in the order they were added.
+    """
+
+    def __init__(self, cls, h5file, ids=None):
+        self._cls = cls
+        self._f = h5file
+        self._ids = list(ids) if ids is not None else []
+        self._idset = set(self._ids)
+        self._cache = {}
+
+    def _load(self, rid):
+        try:
+            return self._cache[rid]
+        except KeyError:
+            pass
+        e = ElementRegistry.for_file(self._f).resolve(rid, self._cls)
+        if e is None:
+            group_name = self._cls.__name__.strip('_')
+            raise NoSuchNodeError('/%s/%s' % (group_name, rid))
+        self._cache[rid] = e
+        return e
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._load(rid) for rid in self._ids[idx]]
+        return self._load(self._ids[idx])
+
+    def __iter__(self):
+        for rid in list(self._ids):
+            yield self._load(rid)
+
+    def __contains__(self, e):
+        root = getattr(e, '_root', None)
+        if root is None or root._v_file is not self._f:
+            return False
+        return root._v_name in self._idset and \
+            root._v_parent._v_name == self._cls.__name__.strip('_')
+
+    def __repr__(self):
+        return 'ElementList({:s}, {:d} elements)'.format(
+            self._cls.__name__.strip('_'), len(self))
+
+    def _add_id(self, rid):
+        self._ids.append(rid)
+        self._idset.add(rid)
+
+    def append(self, e):
+        rid = e._root._v_name
+        self._add_id(rid)
+        self._cache[rid] = e
+
+    @property
+    def ids(self):
+        """
+        IDs of all elements without instantiating them.
+        """
+        return list(self._ids)
+
+
+def _same_rows(a, b):
+    """
+    Return True if two element groups have arrays of the same names and
+    numbers of rows. Elements with the same content hash that differ here
+    were written before appends updated the hash.
+    """
+    la = a._v_leaves
+    lb = b._v_leaves
+    if sorted(la) != sorted(lb):
+        return False
+    return all(la[k].nrows == lb[k].nrows for k in la)
+
+
+def _json_value(val):
+    """
+    Convert attribute values read from an HDF5 file into values that can
+    be serialised to JSON.
+    """
+    if isinstance(val, np.ndarray):
+        if val.ndim == 0:
+            return _json_value(val.item())
+        return [_json_value(v) for v in val.tolist()]
+    if isinstance(val, np.generic):
+        val = val.item()
+    if isinstance(val, bytes):
+        return val.decode('ascii')
+    return val
+
+
+class MmapElement(object):
+    """
+    Read-only element of a dataset exported with
+    :meth:`Dataset.export_mmap`. Array properties are memory-mapped
+    :class:`numpy.ndarray` objects.
+    """
+    __slots__ = ('_dataset', '_cls', '_entry', '_arrays')
+
+    def __init__(self, dataset, cls, entry):
+        object.__setattr__(self, '_dataset', dataset)
+        object.__setattr__(self, '_cls', cls)
+        object.__setattr__(self, '_entry', entry)
+        object.__setattr__(self, '_arrays', {})
+
+    def __getattr__(self, name):
+        entry = self._entry
+        if name in entry['arrays']:
+            try:
+                return self._arrays[name]
+            except KeyError:
+                fn = os.path.join(self._dataset.directory,
+                                  entry['arrays'][name])
+                self._arrays[name] = np.load(fn, mmap_mode='r')
+                return self._arrays[name]
+        if name in entry['references']:
+            val = entry['references'][name]
+            if isinstance(val, list):
+                return [self._dataset._get_element(rid) for rid in val]
+            return self._dataset._get_element(val)
+        if name in entry['attrs']:
+            return entry['attrs'][name]
+        if name == 'tags':
+            return set(entry['tags'])
+        if name in self._cls._properties or name in self._cls._references:
+            return None
+        msg = "'{}' object has no attribute '{}'"
+        raise AttributeError(msg.format(str(self), name))
+
+    def __setattr__(self, name, value):
+        msg = '{} is read only.'
+        raise AttributeError(msg.format(self.__class__.__name__))
+
+    def __str__(self):
+        return self._cls.__name__.strip('_')
+
+    def __repr__(self):
+        return 'MmapElement({:s}, ID: {:s})'.format(str(self),
+                                                    self._entry['id'])
+
+
+class MmapDataset(object):
+    """
+    Read-only dataset backed by the files written by
+    :meth:`Dataset.export_mmap`. Use :meth:`Dataset.open_mmap` to open it.
+
+    :type directory: str
+    :param directory: Directory containing the manifest and array files.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json')) as fh:
+            manifest = json.load(fh)
+        self.elements = {}
+        self._ids = {}
+        for _c in datamodel.all_classes:
+            etype = _c.__name__.strip('_')
+            self.elements[etype] = []
+            for entry in manifest['elements'].get(etype, []):
+                e = MmapElement(self, _c, entry)
+                self.elements[etype].append(e)
+                self._ids[entry['id']] = e
+
+    def _get_element(self, rid):
+        """
+        Return the element with the given ID.
+        """
+        return self._ids.get(rid)
+
+
 class Dataset(object):
     """
     This class is a container for all data describing a spectroscopy analysis
@@ -36,17 +255,45 @@ class Dataset(object):
     :param targets: List of all target plumes that are part of the dataset.
     :type flux: list
     :param flux: List of all flux estimates that are part of the dataset.
+    :type filters: :class:`tables.Filters`
+    :param filters: Default compression filters for all arrays written to
+        a new file, e.g. `tables.Filters(complevel=5, complib='blosc:zstd',
+        shuffle=True)`. They are stored in the file and also apply when it
+        is opened again.
+    :type property_filters: dict
+    :param property_filters: Filters for individual properties overriding
+        the default filters, e.g. `{'d_var': tables.Filters(...)}`.
+    :type journal: bool or dict
+    :param journal: If True, new rows of extendable elements are also
+        published to a journal that other processes can follow with
+        :meth:`Dataset.follow` while the file is being written. A
+        dictionary sets how records are batched into segments and how
+        long segments are kept, e.g. `{'records': 100, 'interval': 5.,
+        'retain': 600.}`. See :class:`Journal` and :meth:`Journal.start`.
+    :type write_behind: dict
+    :param write_behind: Buffer rows appended to extendable elements in
+        memory and write them in larger blocks, e.g. `{'rows': 1000,
+        'nbytes': 2**24, 'interval': 10.}`. Buffered rows are written once
+        an element has collected `rows` rows or `nbytes` bytes, once they
+        are older than `interval` seconds, when an array of the element is
+        read, and on :meth:`flush` and :meth:`close`.
     """
 
-    def __init__(self, filename, mode):
+    def __init__(self, filename, mode, filters=None, property_filters=None,
+                 journal=False, write_behind=None):
         self.elements = {}
         self.base_elements = {}
+        self._rids = {}
+        self._f = tables.open_file(filename, mode, filters=filters)
+        if property_filters is not None:
+            StorageOptions.for_file(self._f).property_filters = \
+                property_filters
         for _c in datamodel.all_classes:
             name = _c.__name__.strip('_')
-            self.elements[name] = []
+            self.elements[name] = ElementList(_c, self._f)
             self.base_elements[name+'Buffer'] = _c
-        self._rids = {}
-        self._f = tables.open_file(filename, mode)
+        if self._f.mode == 'r':
+            return
         # Create an array of sha224 hash values; when
         # opening an existing file this will throw an
         # exception
@@ -55,9 +302,143 @@ class Dataset(object):
                                   tables.StringAtom(itemsize=28), (0,))
         except NodeError:
             pass
+        else:
+            # New files keep track of the time range of their elements
+            self._f.root._v_attrs.time_range = np.zeros(0, dtype=np.int64)
+        self._init_ids()
+        if journal:
+            options = journal if isinstance(journal, dict) else {}
+            Journal.for_file(self._f).start(**options)
+        if write_behind is not None:
+            WriteBehind.for_file(self._f).configure(**write_behind)
+
+    def _scan_ids(self):
+        """
+        Return the ID and path of all elements by walking the element
+        groups.
+        """
+        rows = []
+        for group in self._f.walk_groups('/'):
+            if group._v_name == '/' or group._v_name+'Buffer' \
+               not in self.base_elements:
+                continue
+            for sgroup in list(group._v_groups.keys()):
+                rows.append((sgroup, '/'.join(('', group._v_name, sgroup))))
+        return rows
+
+    def _init_ids(self):
+        """
+        Create the lookup table of element IDs. Files written before the
+        table existed are indexed once by walking all element groups.
+        """
+        if '/IDs' in self._f:
+            return
+        rows = self._scan_ids()
+        tbl = self._f.create_table('/', 'IDs', _IDRecord,
+                                   'Lookup table of element IDs')
+        if len(rows) > 0:
+            tbl.append(rows)
+
+    def _index_element(self, e):
+        """
+        Add an element to the lookup table of element IDs.
+        """
+        self._f.root.IDs.append([(e._root._v_name, e._root._v_pathname)])
+
+    def _read_ids(self):
+        """
+        Read the lookup table and group the element IDs by type. Files
+        without a lookup table that are opened read-only are scanned.
+        """
+        ids = {}
+        if '/IDs' not in self._f:
+            for rid, path in self._scan_ids():
+                ids.setdefault(path.split('/')[1], []).append(rid)
+            return ids
+        rows = self._f.root.IDs.read()
+        for rid, path in zip(rows['id'], rows['path']):
+            etype = path.decode('ascii').split('/')[1]
+            ids.setdefault(etype, []).append(rid.decode('ascii'))
+        return ids
+
+    def _get_element(self, rid):
+        """
+        Return the element with the given ID.
+        """
+        if '/IDs' not in self._f:
+            for etype, elements in self.elements.items():
+                if rid in elements._idset:
+                    return elements._load(rid)
+            return None
+        rows = self._f.root.IDs.read_where('id == rid',
+                                           {'rid': rid.encode('ascii')})
+        if len(rows) < 1:
+            return None
+        etype = rows['path'][0].decode('ascii').split('/')[1]
+        return self.elements[etype]._load(rid)
+
+    def _scan_time_range(self, groups=None):
+        """
+        Return the earliest and latest datetime, in milliseconds since the
+        epoch, of the given element groups or of all elements.
+        """
+        if groups is None:
+            groups = []
+            for etype, ids in self._read_ids().items():
+                _C = self.base_elements[etype+'Buffer']
+                if 'datetime' not in _C._properties:
+                    continue
+                parent = self._f.get_node('/', etype)
+                groups.extend(parent._v_children[rid] for rid in ids)
+        tmin = []
+        tmax = []
+        for group in groups:
+            if 'datetime' not in group:
+                continue
+            node = group._f_get_child('datetime')
+            if node.nrows < 1:
+                continue
+            attrs = node._v_attrs
+            if 'block_min' in attrs:
+                tmin.append(attrs.block_min.min())
+                tmax.append(attrs.block_max.max())
+            else:
+                values = _to_datetime64(node.read()).astype(np.int64)
+                tmin.append(values.min())
+                tmax.append(values.max())
+        if len(tmin) < 1:
+            return np.zeros(0, dtype=np.int64)
+        return np.array([min(tmin), max(tmax)], dtype=np.int64)
+
+    def time_range(self):
+        """
+        Return the earliest and latest datetime of all elements. The range
+        is kept up to date in the file; files written by older versions are
+        scanned.
+
+        :rtype: tuple
+        :returns: Two :class:`numpy.datetime64` or (None, None) if there
+            are no datetimes.
+        """
+        attrs = self._f.root._v_attrs
+        if 'time_range' in attrs:
+            trange = attrs.time_range
+        else:
+            trange = self._scan_time_range()
+        if len(trange) < 2:
+            return (None, None)
+        trange = np.asarray(trange).astype('datetime64[ms]')
+        return (trange[0], trange[1])
 
     def __del__(self):
-        self._f.close()
+        if getattr(self, '_f', None) is not None and self._f.isopen:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __add__(self, other):
         msg = "__add__ is undefined as the return value would "
@@ -65,118 +446,359 @@ class Dataset(object):
         raise AttributeError(msg)
 
     def __iadd__(self, other):
+        self.merge(other)
+        return self
+
+    def merge(self, other, skip_duplicates=False):
+        """
+        Copy all elements of another dataset into this one. The copies
+        get new IDs and references between them are rewritten to the new
+        IDs. Tags are registered if necessary and the content hashes of
+        the copies are added to the hash index.
+
+        :type other: :class:`Dataset`
+        :param other: The dataset to copy the elements from.
+        :type skip_duplicates: bool
+        :param skip_duplicates: If True, elements whose content hash
+            already exists in this dataset are not copied. References to
+            them are rewritten to the existing element with the same hash.
+        :rtype: dict
+        :returns: The number of copied and skipped elements and the time
+            the merge took in seconds.
+        """
         if self._f == other._f:
             raise ValueError("You can't add a dataset to itself.")
-        update_refs = []
-        rid_dict = {}
-        for _e in list(other.elements.keys()):
-            for _k in other.elements[_e]:
-                ne = self._copy_children(_k, copyuserattrs=True)
-                self.elements[_e].append(ne)
-                update_refs.append(ne)
-                rid_dict[str(_k._resource_id)] = str(ne._resource_id)
-
-        for ne in update_refs:
-            for _k, prop_type in ne._references.items():
-                ref = getattr(ne._root._v_attrs, _k, None)
-                if ref is not None:
-                    if prop_type[0] == np.ndarray:
-                        newentry = []
-                        for iref in ref:
-                            newentry.append(rid_dict[iref.decode('ascii')]
-                                            .encode('ascii'))
-                        ne._root._v_attrs[_k] = np.array(newentry)
-                    else:
-                        ne._root._v_attrs[_k] = (rid_dict[ref.decode('ascii')]
-                                                 .encode('ascii'))
-        return self
+        t0 = time.time()
+        other.flush()
+        hashes = HashIndex.for_file(self._f)
+        src_tags = TagIndex.for_file(other._f)
+        # IDs of the elements in this dataset by content hash; only read
+        # for element types with duplicates
+        known = {}
+        rid_map = {}
+        # source groups of the copies by their new ID
+        pending = {}
+        copies = []
+        nskipped = 0
+        for etype, rids in other._read_ids().items():
+            src_parent = other._f.get_node('/', etype)
+            for rid in rids:
+                src = src_parent._v_children[rid]
+                h = getattr(src._v_attrs, 'content_hash', None)
+                # The hashes of elements with appended rows are not in the
+                # hash index
+                appended = 'modification_time' in src._v_attrs
+                if h is not None and skip_duplicates and \
+                        (appended or bytes.fromhex(h) in hashes):
+                    if etype not in known:
+                        known[etype] = self._hash_ids(etype)
+                    dup = known[etype].get(h)
+                    if dup is not None:
+                        try:
+                            group = pending[dup]
+                        except KeyError:
+                            group = self._f.get_node('/' + etype, dup)
+                        if _same_rows(src, group):
+                            rid_map[rid] = dup
+                            nskipped += 1
+                            continue
+                new_rid = str(uuid4())
+                rid_map[rid] = new_rid
+                pending[new_rid] = src
+                copies.append((etype, src, new_rid, h))
+                if h is not None:
+                    known.setdefault(etype, {}).setdefault(h, new_rid)
+
+        tagged = {}
+        new_groups = []
+        with HashIndex.for_file(self._f).deferred(), \
+                warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            parents = {}
+            for etype, src, new_rid, h in copies:
+                try:
+                    parent = parents[etype]
+                except KeyError:
+                    parent = self._type_group(etype)
+                    parents[etype] = parent
+                new_groups.append(src._f_copy(parent, new_rid,
+                                              recursive=True))
+                if h is not None:
+                    hashes.add(bytes.fromhex(h))
+                for tag in src_tags.tags(src._v_name):
+                    tagged.setdefault(tag, []).append(new_rid)
+        self._rewrite_references(new_groups, rid_map)
+        _update_time_range(self._f, self._scan_time_range(new_groups))
+
+        index = TagIndex.for_file(self._f)
+        for tag, rids in tagged.items():
+            if tag not in index:
+                index.register(tag)
+            index.add_many(rids, tag)
+        if len(copies) > 0:
+            self._f.root.IDs.append([(g._v_name, g._v_pathname)
+                                     for g in new_groups])
+        for etype, src, new_rid, h in copies:
+            self.elements[etype]._add_id(new_rid)
+        AttributeIndex.for_file(self._f).reset()
+        self._f.flush()
+        return {'copied': len(copies), 'skipped': nskipped,
+                'seconds': time.time() - t0}
 
-    def _newdst_group(self, dstgroup, title='', filters=None):
+    def _hash_ids(self, etype):
         """
-        Create the destination group in a new HDF5 file.
+        Return the IDs of all elements of a type by their content hash.
         """
-        group = self._f.root
-        # Now, create the new group. This works even if dstgroup == '/'
-        for nodename in dstgroup.split('/'):
-            if nodename == '':
-                continue
-            # First try if possible intermediate groups already exist.
-            try:
-                group2 = self._f.get_node(group, nodename)
-            except NoSuchNodeError:
-                # The group does not exist. Create it.
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore')
-                    group2 = self._f.create_group(group, nodename,
-                                                  title=title,
-                                                  filters=filters)
-            group = group2
-        return group
-
-    def _copy_children(self, src, title='', recursive=True,
-                       filters=None, copyuserattrs=False,
-                       overwrtnodes=False):
-        """
-        Copy the children from source group to destination group
-        """
-        srcgroup = src._root
-        # assign a new resource ID so that both objects can
-        # be referred to within the same session
-        dstgroup = srcgroup._v_parent._v_pathname+'/'
-        dstgroup += str(ResourceIdentifier())
-        # Create the new group
-        dstgroup = self._newdst_group(dstgroup, title, filters)
-
-        # Copy the attributes to dstgroup, if needed
-        if copyuserattrs:
-            srcgroup._v_attrs._f_copy(dstgroup)
-
-        # Finally, copy srcgroup children to dstgroup
+        ids = {}
         try:
-            srcgroup._f_copy_children(
-                dstgroup, recursive=recursive, filters=filters,
-                copyuserattrs=copyuserattrs, overwrite=overwrtnodes)
-        except:
-            msg = "Problems doing the copy of '{:s}'.".format(dstgroup)
-            msg += "Please check that the node names are not "
-            msg += "duplicated in destination, and if so, enable "
-            msg += "overwriting nodes if desired."
-            raise RuntimeError(msg)
-        return type(src)(dstgroup)
+            parent = self._f.get_node('/', etype)
+        except NoSuchNodeError:
+            return ids
+        for rid, group in parent._v_children.items():
+            h = getattr(group._v_attrs, 'content_hash', None)
+            if h is not None:
+                ids.setdefault(h, rid)
+        return ids
 
-    def new(self, data_buffer, pedantic=False):
+    def _rewrite_references(self, groups, rid_map):
         """
-        Create a new entry in the HDF5 file from the given data buffer.
+        Replace the IDs stored in the reference attributes of the given
+        element groups using the mapping from old to new IDs. All
+        references of one name are mapped in a single vectorised lookup.
+        References to IDs not in the mapping are kept.
+        """
+        if len(rid_map) < 1:
+            return
+        old = sorted(rid_map)
+        new = np.array([rid_map[rid] for rid in old], dtype='S60')
+        old = np.array(old, dtype='S60')
+        refs = collections.defaultdict(list)
+        for group in groups:
+            _C = self.base_elements[group._v_parent._v_name + 'Buffer']
+            attrs = group._v_attrs
+            for key in _C._references:
+                if key in attrs:
+                    refs[key].append((attrs, attrs[key]))
+        for key, entries in refs.items():
+            values = np.concatenate([np.atleast_1d(v) for a, v in entries])
+            values = values.astype('S60')
+            idx = np.searchsorted(old, values)
+            idx[idx == len(old)] = 0
+            values = np.where(old[idx] == values, new[idx], values)
+            start = 0
+            for attrs, v in entries:
+                if isinstance(v, np.ndarray):
+                    attrs[key] = np.array(values[start:start+len(v)].tolist())
+                    start += len(v)
+                else:
+                    attrs[key] = values[start]
+                    start += 1
+
+    def _type_group(self, group_name):
+        """
+        Return the group containing all elements of one type.
+        """
+        try:
+            return self._f.get_node('/', group_name)
+        except NoSuchNodeError:
+            return self._f.create_group('/', group_name)
+
+    def _new(self, data_buffer, pedantic, parents):
+        """
+        Write a data buffer to a new element group. Parent groups are
+        looked up in, and added to, the `parents` dictionary.
         """
         if pedantic:
-            s = hashlib.sha224()
             # If data buffer is empty raise an exception
             empty = True
-            for k, v in list(data_buffer.__dict__.items()):
+            for k in data_buffer._properties + data_buffer._references:
                 if k == 'tags':
                     continue
-                if v is not None:
-                    if k in data_buffer._properties:
-                        s.update('{}'.format(v).encode('utf-8'))
+                if getattr(data_buffer, '_'+k) is not None:
                     empty = False
+                    break
             if empty:
                 msg = "You can't add empty buffers if 'pedantic=True'."
                 raise ValueError(msg)
 
         _C = self.base_elements[type(data_buffer).__name__]
         group_name = _C.__name__.strip('_')
-        rid = ResourceIdentifier()
         try:
-            self._f.create_group('/', group_name)
-        except tables.NodeError:
-            pass
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore')
-            group = self._f.create_group('/'+group_name, str(rid))
+            parent = parents[group_name]
+        except KeyError:
+            parent = self._type_group(group_name)
+            parents[group_name] = parent
+        group = self._f.create_group(parent, str(uuid4()))
         e = _C(group, data_buffer, pedantic=pedantic)
         self.elements[group_name].append(e)
         return e
 
+    def new(self, data_buffer, pedantic=False):
+        """
+        Create a new entry in the HDF5 file from the given data buffer.
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            e = self._new(data_buffer, pedantic, {})
+        self._index_element(e)
+        return e
+
+    def new_many(self, data_buffers, pedantic=False):
+        """
+        Create new entries in the HDF5 file from a sequence of data
+        buffers of any type. This is a convenience wrapper around
+        :meth:`new`: every element still gets its own group and arrays,
+        only the hash values and IDs are written in one go and the file is
+        flushed once at the end. It is therefore only slightly faster than
+        calling :meth:`new` for every buffer.
+
+        :type data_buffers: list
+        :param data_buffers: The data buffers to write.
+        :type pedantic: bool
+        :param pedantic: If True, raise a ValueError for empty or
+            duplicate buffers. Elements created before the error are kept.
+        :rtype: list
+        :returns: The new elements in the same order as the data buffers.
+        """
+        parents = {}
+        elements = []
+        try:
+            with HashIndex.for_file(self._f).deferred(), \
+                    ElementRegistry.for_file(self._f).deferred(), \
+                    warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for data_buffer in data_buffers:
+                    elements.append(self._new(data_buffer, pedantic,
+                                              parents))
+        finally:
+            if len(elements) > 0:
+                self._f.root.IDs.append([(e._root._v_name,
+                                          e._root._v_pathname)
+                                         for e in elements])
+            self._f.flush()
+        return elements
+
+    def _repack_group(self, src, dst, filters, property_filters,
+                      extendable=None):
+        """
+        Recursively copy the children of a group applying new filters.
+        Arrays of elements get new chunkshapes depending on whether the
+        element type is extendable or not.
+        """
+        h5f = dst._v_file
+        for node in src._f_iter_nodes():
+            if isinstance(node, tables.Group):
+                name = node._v_name
+                ext = extendable
+                if name+'Buffer' in self.base_elements:
+                    ext = hasattr(self.base_elements[name+'Buffer'],
+                                  'append')
+                group = h5f.create_group(dst, name, title=node._v_title)
+                node._v_attrs._f_copy(group)
+                self._repack_group(node, group, filters, property_filters,
+                                   ext)
+            elif isinstance(node, tables.EArray) and extendable is not None:
+                _filters = property_filters.get(node.name, filters)
+                chunkshape = _chunkshape(node.shape, node.atom.itemsize,
+                                         extendable)
+                node.copy(dst, filters=_filters, chunkshape=chunkshape)
+            else:
+                node.copy(dst, filters=filters)
+
+    def repack(self, filename, filters=None, property_filters=None):
+        """
+        Write a copy of the dataset to a new file using new compression
+        filters and return the new dataset. Chunkshapes are recomputed
+        for all arrays.
+
+        :type filename: str
+        :param filename: Name of the new HDF5 file.
+        :type filters: :class:`tables.Filters`
+        :param filters: Default filters of the new file. If None, the
+            default filters of this dataset are kept.
+        :type property_filters: dict
+        :param property_filters: Filters for individual properties. If
+            None, the property filters of this dataset are kept.
+        """
+        if filters is None:
+            filters = self._f.filters
+        if property_filters is None:
+            property_filters = StorageOptions.for_file(self._f)\
+                .property_filters
+        self.flush()
+        with tables.open_file(filename, 'w', filters=filters) as h5f, \
+                warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self._f.root._v_attrs._f_copy(h5f.root)
+            self._repack_group(self._f.root, h5f.root, filters,
+                               property_filters)
+        dnew = Dataset(filename, 'r+', property_filters=property_filters)
+        dnew._open_elements(lazy=True)
+        return dnew
+
+    def export_mmap(self, directory):
+        """
+        Export the dataset for fast, read-only access. Every array property
+        is written to its own `.npy` file and all other properties,
+        references and tags to `manifest.json`. The files can be memory
+        mapped with `np.load(fn, mmap_mode='r')` or opened with
+        :meth:`Dataset.open_mmap`. Datetime arrays are stored as
+        `datetime64[ms]`.
+
+        :type directory: str
+        :param directory: Output directory. It is created if it doesn't
+            exist yet.
+        """
+        self.flush()
+        tags = TagIndex.for_file(self._f)
+        elements = {}
+        for etype, ids in self._read_ids().items():
+            _C = self.base_elements[etype+'Buffer']
+            entries = []
+            for rid in ids:
+                group = self._f.get_node('/' + etype, rid)
+                outdir = os.path.join(directory, etype, rid)
+                if not os.path.isdir(outdir):
+                    os.makedirs(outdir)
+                arrays = {}
+                for name, node in group._v_leaves.items():
+                    data = node.read()
+                    if _C._properties.get(name) == (np.ndarray,
+                                                    datetime.datetime):
+                        data = data.astype('datetime64[ms]')
+                    np.save(os.path.join(outdir, name + '.npy'),
+                            np.ascontiguousarray(data))
+                    arrays[name] = '/'.join((etype, rid, name + '.npy'))
+                attrs = {}
+                references = {}
+                for key in group._v_attrs._v_attrnamesuser:
+                    val = _json_value(group._v_attrs[key])
+                    if key in _C._references:
+                        references[key] = val
+                    else:
+                        attrs[key] = val
+                entries.append({'id': rid, 'attrs': attrs,
+                                'references': references,
+                                'arrays': arrays,
+                                'tags': sorted(tags.tags(rid))})
+            elements[etype] = entries
+        # Write the manifest last so readers never see a partial export
+        fn = os.path.join(directory, 'manifest.json')
+        with open(fn + '.tmp', 'w') as fh:
+            json.dump({'version': 1, 'elements': elements}, fh)
+        os.replace(fn + '.tmp', fn)
+
+    @staticmethod
+    def open_mmap(directory):
+        """
+        Open a dataset exported with :meth:`Dataset.export_mmap`.
+
+        :type directory: str
+        :param directory: Directory the dataset was exported to.
+        :rtype: :class:`MmapDataset`
+        """
+        return MmapDataset(directory)
+
     def read(self, filename, ftype, **kwargs):
         """
         Read in a datafile.
@@ -185,76 +807,723 @@ class Dataset(object):
         pg = plugins[ftype.lower()]()
         return pg.read(self, filename, **kwargs)
 
+    def _write_result(self, result):
+        """
+        Write the buffers returned by a plugin to the dataset and return
+        the result with every buffer replaced by its new element. Buffers
+        keyed by their class name are keyed by the element's class name
+        instead. Elements and other values are returned unchanged.
+        """
+        if isinstance(result, dict):
+            keys = [k for k, v in result.items()
+                    if type(v).__name__ in self.base_elements]
+            elements = self.new_many([result[k] for k in keys])
+            written = dict(result)
+            for k, e in zip(keys, elements):
+                del written[k]
+                written[str(e) if k == str(result[k]) else k] = e
+            return written
+        if type(result).__name__ in self.base_elements:
+            return self.new(result)
+        return result
+
+    def read_many(self, filenames, ftype, workers=None, callback=None,
+                  **kwargs):
+        """
+        Read in many datafiles of the same type and write them to the
+        dataset.
+
+        Files are parsed in a pool of worker processes. The buffers are
+        handed back to this process, which stays the only writer to the
+        HDF5 file, and written with :meth:`new_many` in the order of
+        `filenames`. References between the buffers of one file are not
+        set. Plugins that need the dataset while reading (see
+        :meth:`DatasetPluginBase.needs_dataset`) read the files one after
+        the other in this process regardless of `workers`.
+
+        :type filenames: list
+        :param filenames: Files to read.
+        :type ftype: str
+        :param ftype: File format as understood by :meth:`read`.
+        :type workers: int
+        :param workers: Number of worker processes. Defaults to the number
+            of CPUs. With 0 or 1 files are read one after the other in
+            this process.
+        :type callback: callable
+        :param callback: Called as ``callback(filename, elements)`` for
+            every file that was read and written successfully, in the
+            order of `filenames` and while the remaining files are still
+            being parsed.
+        :rtype: list
+        :returns: One entry per file in the order of `filenames`: the
+            return value of the plugin with all buffers replaced by their
+            elements, or the exception raised by the plugin, while writing
+            or by the callback for that file. A failing file does not abort
+            the batch.
+        """
+        filenames = list(filenames)
+        plugins = get_registered_plugins()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(filenames))
+        if plugins[ftype.lower()]().needs_dataset(**kwargs):
+            workers = 0
+
+        def finish(filename, result):
+            if isinstance(result, Exception):
+                return result
+            try:
+                result = self._write_result(result)
+                if callback is not None:
+                    callback(filename, result)
+            except Exception as e:
+                result = e
+            return result
+
+        results = []
+        if workers <= 1:
+            for filename in filenames:
+                try:
+                    pg = plugins[ftype.lower()]()
+                    result = pg.read(self, filename, **kwargs)
+                except Exception as e:
+                    result = e
+                results.append(finish(filename, result))
+            return results
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_read_file, ftype, filename, kwargs)
+                       for filename in filenames]
+            for filename, future in zip(filenames, futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # e.g. a result that could not be pickled or a worker
+                    # that died
+                    result = e
+                results.append(finish(filename, result))
+        return results
+
     @staticmethod
-    def open(filename):
+    def open(filename, lazy=False, mode='r+', journal=False,
+             write_behind=None):
         """
         Open an existing HDF5 file.
+
+        :type lazy: bool
+        :param lazy: If True, elements are only instantiated when they are
+            first accessed. Otherwise all elements are instantiated when
+            the file is opened.
+        :type mode: str
+        :param mode: 'r+' to open the file for reading and writing or 'r'
+            to open it read-only.
+        :type journal: bool or dict
+        :param journal: If True, publish new rows of extendable elements
+            to a journal. See :class:`Dataset`.
+        :type write_behind: dict
+        :param write_behind: Limits of the write-behind buffer for
+            appended rows. See :class:`Dataset`.
         """
-        dnew = Dataset(filename, 'r+')
-        for group in dnew._f.walk_groups('/'):
-            if group._v_name is '/' or group._v_name+'Buffer' \
-               not in dnew.base_elements:
-                continue
-            for sgroup in list(group._v_groups.keys()):
-                _C = dnew.base_elements[group._v_name+'Buffer']
-                e = _C(group._v_groups[sgroup])
-                dnew.elements[group._v_name].append(e)
+        dnew = Dataset(filename, mode, journal=journal,
+                       write_behind=write_behind)
+        dnew._open_elements(lazy)
         return dnew
 
+    @staticmethod
+    def follow(filename):
+        """
+        Follow the journal of an HDF5 file that is being written by
+        another process. See :class:`JournalReader`.
+        """
+        return JournalReader(filename)
+
+    @staticmethod
+    def open_many(filenames):
+        """
+        Open many HDF5 files as a single read-only dataset. See
+        :class:`MultiDataset`.
+        """
+        return MultiDataset(filenames)
+
+    def _open_elements(self, lazy):
+        """
+        Populate the element lists from the lookup table.
+        """
+        with ElementRegistry.for_file(self._f).deferred():
+            for etype, ids in self._read_ids().items():
+                _C = self.base_elements[etype+'Buffer']
+                self.elements[etype] = ElementList(_C, self._f, ids)
+                if not lazy:
+                    list(self.elements[etype])
+
+    @property
+    def closed(self):
+        """
+        True if the HDF5 file has been closed.
+        """
+        return not self._f.isopen
+
+    def flush(self):
+        """
+        Write all buffered rows and flush the HDF5 file to disk.
+        """
+        if self._f.mode == 'r' or not self._f.isopen:
+            return
+        WriteBehind.for_file(self._f).flush()
+        Journal.for_file(self._f).flush()
+        self._f.flush()
+
     def close(self):
         """
-        Close the HDF5 file and clear the ResourceIdentifiers.
+        Write all buffered rows and close the HDF5 file. The in-memory
+        indexes of the file and all cached elements are released. Closing
+        a dataset more than once has no effect.
         """
+        if not self._f.isopen:
+            return
+        self.flush()
         for g in self.elements:
-            for e in self.elements[g]:
-                del e._resource_id
+            self.elements[g]._cache.clear()
+        ElementRegistry.for_file(self._f).clear()
+        Journal.for_file(self._f).stop()
+        _FileIndex.release(self._f)
         self._f.close()
 
     def register_tags(self, tags):
         """
         Register one or more tag names.
         """
-        try:
-            self._f.create_group('/', 'tags')
-        except NodeError:
-            pass
+        index = TagIndex.for_file(self._f)
         for tag in tags:
-            try:
-                self._f.create_earray('/tags', tag,
-                                      tables.StringAtom(itemsize=60), (0,))
-            except NodeError:
-                msg = "Tag '{:s}' has already been registered".format(tag)
-                raise ValueError(msg)
+            index.register(tag)
 
     def remove_tags(self, tags):
         """
         Remove one or more tag names. This will also remove the tag from every
         element that had been tagged.
         """
+        index = TagIndex.for_file(self._f)
         for tag in tags:
-            try:
-                ea = self._f.root.tags._v_children[tag]
-                for rid in ea[:]:
-                    e = (ResourceIdentifier(rid.astype(np.str_))
-                         .get_referred_object())
-                    e.tags.remove(tag)
-            except (KeyError, NoSuchNodeError):
+            if tag not in index:
                 msg = "Can't remove tag {} as it doesn't exist.".format(tag)
                 warnings.warn(msg)
+                continue
+            for rid in index.ids(tag):
+                e = self._get_element(rid)
+                e.tags.remove(tag)
+
+    def time_slice(self, e, datemin=None, datemax=None, exclusive=False):
+        """
+        Return the rows of an element whose datetime lies within
+        [datemin, datemax], e.g. to read only those spectra with
+        `e.d_var[s]`. Only the parts of the datetime array needed to find
+        the window are read.
+
+        :type e: element
+        :param e: Element with a datetime array.
+        :type datemin: str, :class:`datetime.datetime` or
+            :class:`numpy.datetime64`
+        :param datemin: Start of the time window. Open if None.
+        :type datemax: str, :class:`datetime.datetime` or
+            :class:`numpy.datetime64`
+        :param datemax: End of the time window. Open if None.
+        :type exclusive: bool
+        :param exclusive: If True, leave out rows at datemin and datemax,
+            i.e. return the rows within (datemin, datemax).
+        :rtype: slice or :class:`numpy.ndarray`
+        :returns: A slice if the datetimes are in chronological order,
+            otherwise the indices of the matching rows.
+        """
+        if getattr(e, '_write_behind', None) is not None:
+            e._write_behind.flush(e)
+        try:
+            node = e._root.datetime
+        except NoSuchNodeError:
+            return slice(0, 0)
+        return _time_window(node, datemin, datemax, exclusive)
+
+    def _attribute_index(self, etype):
+        """
+        Return the attribute index after making sure the given element
+        type has been indexed.
+        """
+        index = AttributeIndex.for_file(self._f)
+        if not index.loaded(etype):
+            index.load(etype, self.elements[etype].ids)
+        return index
+
+    def _match(self, etype, path, value):
+        """
+        Return the IDs of all elements of a type matching a single
+        equality clause. The path can follow references, e.g.
+        'type.acquisition'.
+        """
+        _C = self.base_elements[etype+'Buffer']
+        key, _, rest = path.partition('.')
+        if not rest:
+            if key == 'tags':
+                return set(TagIndex.for_file(self._f).ids(value))
+            if key not in _C._properties and key not in _C._references:
+                return set()
+            return self._attribute_index(etype).lookup(etype, key, value)
+        if key not in _C._references:
+            return set()
+        ref_type = _C._references[key][-1].__name__.strip('_')
+        matches = set()
+        index = self._attribute_index(etype)
+        for rid in self._match(ref_type, rest, value):
+            matches |= index.lookup(etype, key, rid)
+        return matches
 
     def select(self, *args, **kargs):
         """
-        Find a subset of events based on given select rules.
+        Find a subset of elements based on given select rules. All rules
+        have to match.
+
+        Positional arguments are queries of the form
+        "<property> == '<value>'" which can be combined with 'and'. The
+        property can follow references to other elements, e.g.
+        "type.acquisition == 'stationary'", and "tags == '<tag>'" matches
+        tagged elements.
+
+        :type etype: str or list
+        :param etype: Element type(s) to search. Defaults to all types.
+        :type tags: str or list
+        :param tags: Tag(s) the elements need to have.
+        :type datemin: str, :class:`datetime.datetime` or
+            :class:`numpy.datetime64`
+        :param datemin: Only return elements with at least one datetime
+            after datemin.
+        :type datemax: str, :class:`datetime.datetime` or
+            :class:`numpy.datetime64`
+        :param datemax: Only return elements with at least one datetime
+            before datemax.
+
+        Any other keyword argument is compared to the scalar property of
+        the same name, e.g. `gas_species='SO2'`. A list of values matches
+        any of them.
+
+        :rtype: dict
+        :returns: The matching elements for every searched element type.
+        """
+        etype = kargs.pop('etype', None)
+        tags = kargs.pop('tags', None)
+        datemin = kargs.pop('datemin', None)
+        datemax = kargs.pop('datemax', None)
+        if etype is None:
+            etypes = sorted(self.elements.keys())
+        elif isinstance(etype, str):
+            etypes = [etype]
+        else:
+            etypes = list(etype)
+
+        clauses = []
+        for query in args:
+            for clause in re.split(r'\s+and\s+', query):
+                m = _query_clause.match(clause)
+                if m is None:
+                    msg = "Can't parse query '{:s}'.".format(clause)
+                    raise ValueError(msg)
+                clauses.append((m.group(1), [m.group(3)]))
+        if tags is not None:
+            if isinstance(tags, str):
+                tags = [tags]
+            for tag in tags:
+                clauses.append(('tags', [tag]))
+        for key, value in kargs.items():
+            if not isinstance(value, (list, tuple, set)):
+                value = [value]
+            clauses.append((key, value))
+
+        result = {}
+        for _e in etypes:
+            _C = self.base_elements[_e+'Buffer']
+            if (datemin is not None or datemax is not None) and \
+               'datetime' not in _C._properties:
+                continue
+            ids = None
+            for path, values in clauses:
+                matches = set()
+                for value in values:
+                    matches |= self._match(_e, path, value)
+                ids = matches if ids is None else ids & matches
+                if not ids:
+                    break
+            elements = self.elements[_e]
+            if ids is not None:
+                # Keep the order in which the elements were added
+                elements = [elements._load(rid) for rid in elements.ids
+                            if rid in ids]
+            if datemin is not None or datemax is not None:
+                _elements = []
+                for e in elements:
+                    rows = self.time_slice(e, datemin, datemax)
+                    if isinstance(rows, slice):
+                        if rows.stop > rows.start:
+                            _elements.append(e)
+                    elif len(rows) > 0:
+                        _elements.append(e)
+                elements = _elements
+            result[_e] = list(elements)
+        return result
+
+
+class JournalReader(object):
+    """
+    Reader for the journal of an HDF5 file that another process writes
+    with `journal=True`. Readers poll for new segments and never lock or
+    open the HDF5 file. When the writer starts a new session the reader
+    starts again from its first segment.
+
+    Segments are removed by the writer after a while. A reader that falls
+    that far behind continues with the oldest segment left and counts the
+    segments it missed in `skipped`; the missing rows have to be read
+    from the HDF5 file.
+
+    :type filename: str
+    :param filename: Name of the HDF5 file being written.
+    """
+
+    def __init__(self, filename):
+        self.directory = Journal.path(filename)
+        self.session = None
+        self.skipped = 0
+        self._seq = 0
+
+    def _first(self, session):
+        """
+        Return the number of the oldest segment of a session.
+        """
+        try:
+            with open(os.path.join(self.directory, session, 'first')) as fh:
+                return int(fh.read())
+        except FileNotFoundError:
+            return 0
+
+    def poll(self):
+        """
+        Return the records published since the last call in the order
+        they were written.
+
+        :rtype: list
+        :returns: A tuple (element type, element ID, arrays) for every
+            record where arrays is a dictionary of the written arrays.
         """
         try:
-            etype = kargs['etype']
+            with open(os.path.join(self.directory, 'current')) as fh:
+                session = fh.read()
+        except FileNotFoundError:
+            return []
+        if session != self.session:
+            self.session = session
+            self._seq = 0
+        records = []
+        while True:
+            fn = os.path.join(self.directory, session,
+                              '{:010d}.npz'.format(self._seq))
+            try:
+                with np.load(fn) as data:
+                    arrays = dict((key, data[key]) for key in data.files)
+            except FileNotFoundError:
+                first = self._first(session)
+                if first <= self._seq:
+                    break
+                self.skipped += first - self._seq
+                self._seq = first
+                continue
+            segment = collections.defaultdict(dict)
+            for key, val in arrays.items():
+                i, name = key.split(':', 1)
+                segment[int(i)][name] = val
+            for i in sorted(segment):
+                record = segment[i]
+                etype = str(record.pop('__type__'))
+                rid = str(record.pop('__id__'))
+                records.append((etype, rid, record))
+            self._seq += 1
+        return records
+
+
+class MultiElementList(object):
+    """
+    List of all elements of one type in a :class:`MultiDataset`. Elements
+    are only instantiated, and their files opened, when they are first
+    accessed.
+
+    :type dataset: :class:`MultiDataset`
+    :param dataset: The dataset the elements belong to.
+    :type etype: str
+    :param etype: The element type.
+    """
+
+    def __init__(self, dataset, etype):
+        self._dataset = dataset
+        self._etype = etype
+        # (file number, ID) of all elements in file order
+        self._entries = []
+
+    def _load(self, entry):
+        fileno, rid = entry
+        return self._dataset._open(fileno).elements[self._etype]._load(rid)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._load(entry) for entry in self._entries[idx]]
+        return self._load(self._entries[idx])
+
+    def __iter__(self):
+        for entry in list(self._entries):
+            yield self._load(entry)
+
+    def __repr__(self):
+        return 'MultiElementList({:s}, {:d} elements)'.format(self._etype,
+                                                              len(self))
+
+    @property
+    def ids(self):
+        """
+        IDs of all elements without instantiating them.
+        """
+        return [rid for fileno, rid in self._entries]
+
+
+class MultiDataset(object):
+    """
+    Read-only union of many datasets, e.g. one file per station and day.
+    When the dataset is created every file is opened once to read its
+    element IDs and time range. Afterwards files are only opened when one
+    of their elements is accessed or when their time range overlaps the
+    time window of a query. Use :meth:`Dataset.open_many` to create it.
+
+    :type filenames: list
+    :param filenames: Names of the HDF5 files.
+    """
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.elements = {}
+        for _c in datamodel.all_classes:
+            etype = _c.__name__.strip('_')
+            self.elements[etype] = MultiElementList(self, etype)
+        self._datasets = {}
+        self._files = {}
+        self._time_ranges = []
+        for fileno, fn in enumerate(self.filenames):
+            d = Dataset(fn, 'r')
+            try:
+                for etype, ids in d._read_ids().items():
+                    self.elements[etype]._entries.extend(
+                        (fileno, rid) for rid in ids)
+                    for rid in ids:
+                        self._files[rid] = (fileno, etype)
+                self._time_ranges.append(d.time_range())
+            finally:
+                d.close()
+
+    def _open(self, fileno):
+        """
+        Return the dataset of a file and open it if necessary.
+        """
+        try:
+            return self._datasets[fileno]
         except KeyError:
-            etype = False
+            d = Dataset.open(self.filenames[fileno], lazy=True, mode='r')
+            self._datasets[fileno] = d
+            return d
+
+    def _get_element(self, rid):
+        """
+        Return the element with the given ID.
+        """
+        try:
+            fileno, etype = self._files[rid]
+        except KeyError:
+            return None
+        return self._open(fileno).elements[etype]._load(rid)
+
+    def _overlapping(self, datemin=None, datemax=None):
+        """
+        Return the numbers of the files whose time range overlaps
+        [datemin, datemax].
+        """
+        tmin = np.datetime64(_datetime_ms(datemin), 'ms') \
+            if datemin is not None else None
+        tmax = np.datetime64(_datetime_ms(datemax), 'ms') \
+            if datemax is not None else None
+        filenos = []
+        for fileno, (t0, t1) in enumerate(self._time_ranges):
+            if t0 is None:
+                continue
+            if tmin is not None and t1 < tmin:
+                continue
+            if tmax is not None and t0 > tmax:
+                continue
+            filenos.append(fileno)
+        return filenos
+
+    def time_range(self):
+        """
+        Return the earliest and latest datetime of all files.
+
+        :rtype: tuple
+        :returns: Two :class:`numpy.datetime64` or (None, None) if there
+            are no datetimes.
+        """
+        ranges = [r for r in self._time_ranges if r[0] is not None]
+        if len(ranges) < 1:
+            return (None, None)
+        return (min(r[0] for r in ranges), max(r[1] for r in ranges))
+
+    def files(self, datemin=None, datemax=None):
+        """
+        Return the names of the files whose time range overlaps
+        [datemin, datemax].
+        """
+        return [self.filenames[fileno]
+                for fileno in self._overlapping(datemin, datemax)]
+
+    def time_slice(self, e, datemin=None, datemax=None, exclusive=False):
+        """
+        Return the rows of an element whose datetime lies within
+        [datemin, datemax]. See :meth:`Dataset.time_slice`.
+        """
+        try:
+            node = e._root.datetime
+        except NoSuchNodeError:
+            return slice(0, 0)
+        return _time_window(node, datemin, datemax, exclusive)
+
+    def select(self, *args, **kargs):
+        """
+        Find a subset of elements in all files. The arguments are the same
+        as for :meth:`Dataset.select`. If a time window is given, only the
+        files whose time range overlaps it are opened.
+
+        :rtype: dict
+        :returns: The matching elements for every searched element type in
+            the order of the files.
+        """
+        if kargs.get('datemin') is not None or \
+           kargs.get('datemax') is not None:
+            filenos = self._overlapping(kargs.get('datemin'),
+                                        kargs.get('datemax'))
+        else:
+            filenos = range(len(self.filenames))
+        result = {}
+        for fileno in filenos:
+            for etype, elements in \
+                    self._open(fileno).select(*args, **kargs).items():
+                result.setdefault(etype, []).extend(elements)
+        return result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close all open files.
+        """
+        for d in self._datasets.values():
+            d.close()
+        self._datasets = {}
+
+
+class DatasetPool(object):
+    """
+    Pool of open datasets for long-running workers that access many files.
+    At most `maxsize` datasets are kept open; when another one is opened,
+    the least recently used dataset that is not in use is closed. Datasets
+    are in use from :meth:`acquire` until :meth:`release`, or within
+    :meth:`dataset`. The pool is thread-safe.
+
+    >>> pool = DatasetPool(maxsize=16)
+    >>> with pool.dataset(filename) as d:  # doctest: +SKIP
+    ...     d.elements['RawData'][0]
+
+    :type maxsize: int
+    :param maxsize: Maximum number of datasets kept open.
+    :type lazy: bool
+    :param lazy: Open datasets without instantiating their elements.
+    """
+
+    def __init__(self, maxsize=64, lazy=True):
+        self.maxsize = maxsize
+        self.lazy = lazy
+        # (filename, mode) -> [dataset, number of users]
+        self._open = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-        if etype:
-            # retval = []
-            for _e in self.elements[etype]:
-                pass
+    def __len__(self):
+        return len(self._open)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def acquire(self, filename, mode='r'):
+        """
+        Return the open dataset of a file and mark it as in use.
+        """
+        key = (os.path.abspath(filename), mode)
+        with self._lock:
+            try:
+                entry = self._open.pop(key)
+            except KeyError:
+                entry = [Dataset.open(filename, lazy=self.lazy, mode=mode),
+                         0]
+            entry[1] += 1
+            self._open[key] = entry
+            self._evict()
+            return entry[0]
+
+    def release(self, d):
+        """
+        Mark a dataset returned by :meth:`acquire` as no longer in use.
+        """
+        with self._lock:
+            for entry in self._open.values():
+                if entry[0] is d:
+                    entry[1] -= 1
+                    break
+            self._evict()
+
+    @contextlib.contextmanager
+    def dataset(self, filename, mode='r'):
+        """
+        Context manager returning the open dataset of a file.
+        """
+        d = self.acquire(filename, mode)
+        try:
+            yield d
+        finally:
+            self.release(d)
+
+    def _evict(self):
+        # the least recently used datasets come first
+        for key in list(self._open.keys()):
+            if len(self._open) <= self.maxsize:
+                break
+            d, users = self._open[key]
+            if users < 1:
+                del self._open[key]
+                d.close()
+
+    def close(self):
+        """
+        Close all datasets of the pool.
+        """
+        with self._lock:
+            for d, users in self._open.values():
+                d.close()
+            self._open.clear()
 
 
 if __name__ == '__main__':
@@ -1,4 +1,5 @@
-import os
+import importlib
+import threading
 import warnings
 
 
@@ -20,69 +21,202 @@ class DatasetPluginBase(object):
     def close(self, filename):
         raise Exception("'close' is undefined")
 
+    def needs_dataset(self, **kargs):
+        """
+        Return True if :meth:`read`, called with the given keyword
+        arguments, writes to the dataset itself instead of only returning
+        buffers. Such files can't be parsed in worker processes by
+        :meth:`Dataset.read_many`.
+        """
+        return False
+
     @staticmethod
     def get_format():
         return 'base'
 
 
-def load_all_plugins():
+# Formats of the plug-ins shipped with this package and the classes
+# implementing them. Modules are only imported when a format is first used.
+_builtin_plugins = {
+    'flyspec': 'spectroscopy.plugins.flyspec:FlySpecPlugin',
+    'flyspecflux': 'spectroscopy.plugins.flyspec:FlySpecFluxPlugin',
+    'flyspecref': 'spectroscopy.plugins.flyspec:FlySpecRefPlugin',
+    'flyspecwind': 'spectroscopy.plugins.flyspec:FlySpecWindPlugin',
+    'minidoas-raw': 'spectroscopy.plugins.minidoas:MiniDoasRaw',
+    'minidoas-spectra': 'spectroscopy.plugins.minidoas:MiniDoasSpectra',
+    'minidoas-scan': 'spectroscopy.plugins.minidoas:MiniDoasScan',
+    'minidoas-wind': 'spectroscopy.plugins.minidoas:MiniDoasWind',
+    'nzmetservice': 'spectroscopy.plugins.nzmetservice:NZMetservicePlugin',
+}
+
+# Entry point group for plug-ins distributed in other packages, e.g. in
+# setup.py:
+# entry_points={'spectroscopy.plugins': ['myformat = mypkg.mod:MyPlugin']}
+ENTRY_POINT_GROUP = 'spectroscopy.plugins'
+
+
+def _entry_points(group):
     """
-    Loads all installed spectroscopy dataset plug-ins.
-    Plugins that cannot be loaded will be skipped and
-    a warning message issued.
+    Return the installed entry points of a group.
     """
-    # import all the plugins from the plugins directory
-    plugins_directory = __path__[0]
-
-    cur_dir = os.getcwd()
-    os.chdir(plugins_directory)
-
-    # only attempt to import python files and directories
-    plugin_list = []
-    for f in [f for f in os.listdir(os.path.curdir)]:
-        # exclude any hidden files
-        if f.startswith('.'):
-            continue
-
-        # include any python modules
-        if f.endswith('.py'):
-            plugin_list.append(f)
-            continue
-
-        # include directories only if they are Python packages (look
-        # for __init__.py file)
-        if os.path.isdir(f):
-            if '__init__.py' in os.listdir(f):
-                plugin_list.append(f)
-
-    for plugin in plugin_list:
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))
+
+
+class PluginRegistry(object):
+    """
+    Mapping of format names to plug-in classes.
+
+    Format names are known without importing anything. The module of a
+    plug-in is imported when its format is first looked up. Plug-ins of
+    other packages are found through the entry point group
+    :data:`ENTRY_POINT_GROUP`. All methods are safe to call from multiple
+    threads.
+    """
+
+    def __init__(self, plugins=None, entry_points=True):
+        """
+        :type plugins: dict
+        :param plugins: Maps format names to ``'module:Class'`` strings.
+            Defaults to the plug-ins shipped with this package.
+        :type entry_points: bool
+        :param entry_points: If True, also register the plug-ins of the
+            entry point group :data:`ENTRY_POINT_GROUP`.
+        """
+        if plugins is None:
+            plugins = _builtin_plugins
+        self._targets = dict(plugins)
+        self._classes = {}
+        self._entry_points = entry_points
+        self._discovered = False
+        self._lock = threading.RLock()
+
+    def _discover(self):
+        if self._discovered:
+            return
+        with self._lock:
+            if self._discovered:
+                return
+            if self._entry_points:
+                for ep in _entry_points(ENTRY_POINT_GROUP):
+                    name = ep.name.lower()
+                    if name in self._targets:
+                        msg = "Plug-in format {} of entry point {} is "
+                        msg += "already registered and will be skipped."
+                        warnings.warn(msg.format(name, ep.value))
+                        continue
+                    self._targets[name] = ep.value
+            self._discovered = True
+
+    def register(self, name, target):
+        """
+        Register a plug-in.
+
+        :type name: str
+        :param name: Format name.
+        :type target: str or class
+        :param target: The plug-in class or a ``'module:Class'`` string
+            pointing to it.
+        """
+        name = name.lower()
+        with self._lock:
+            self._discover()
+            if name in self._targets:
+                msg = "Plug-in format {} is already registered."
+                raise DatasetPluginBaseException(msg.format(name))
+            if isinstance(target, str):
+                self._targets[name] = target
+            else:
+                self._targets[name] = '{}:{}'.format(target.__module__,
+                                                     target.__name__)
+                self._classes[name] = target
+
+    def _import(self, name):
+        target = self._targets[name]
+        modname, _, qualname = target.partition(':')
         try:
-            __import__("spectroscopy.plugins." + plugin.rstrip(".py"),
-                       fromlist=["spectroscopy.plugins"], globals=globals(),
-                       locals=locals())
+            obj = importlib.import_module(modname)
+            for attr in qualname.split('.'):
+                obj = getattr(obj, attr)
         except Exception as e:
-            # skip over any plugins that we cannot import
-            msg = "Failed to import plug-in {}\n"
-            msg += "register() raised the exception: {}"
-            warnings.warn(msg.format(plugin, e.args[0]))
+            msg = "Failed to import plug-in {} from {}: {}"
+            raise DatasetPluginBaseException(msg.format(name, target, e))
+        return obj
+
+    def __getitem__(self, name):
+        name = name.lower()
+        try:
+            return self._classes[name]
+        except KeyError:
+            pass
+        self._discover()
+        with self._lock:
+            if name not in self._classes:
+                if name not in self._targets:
+                    raise KeyError(name)
+                self._classes[name] = self._import(name)
+            return self._classes[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        self._discover()
+        return name.lower() in self._targets
+
+    def keys(self):
+        self._discover()
+        return sorted(self._targets)
 
-    # return to the old working dir
-    os.chdir(cur_dir)
+    def __iter__(self):
+        return iter(self.keys())
 
-    registered_plugins = {}
+    def __len__(self):
+        return len(self.keys())
 
-    for c in DatasetPluginBase.__subclasses__():
-        assert c.get_format() not in registered_plugins
+    def load_all(self):
+        """
+        Import all plug-ins. Plug-ins that cannot be imported are skipped
+        and a warning is issued.
 
-        registered_plugins[c.get_format()] = c
+        :rtype: dict
+        :returns: Format names mapped to plug-in classes.
+        """
+        plugins = {}
+        for name in self.keys():
+            try:
+                plugins[name] = self[name]
+            except DatasetPluginBaseException as e:
+                warnings.warn(str(e))
+        return plugins
 
-    return registered_plugins
+
+_registry = PluginRegistry()
+
+
+def load_all_plugins():
+    """
+    Loads all installed spectroscopy dataset plug-ins.
+    Plugins that cannot be loaded will be skipped and
+    a warning message issued.
+    """
+    return _registry.load_all()
 
 
 def get_registered_plugins():
+    """
+    Return the registry of installed plug-ins. Plug-ins are imported when
+    they are first looked up.
 
-    if hasattr(get_registered_plugins, 'registered_plugins'):
-        return get_registered_plugins.registered_plugins
-    else:
-        get_registered_plugins.registered_plugins = load_all_plugins()
-        return get_registered_plugins.registered_plugins
+    :rtype: :class:`PluginRegistry`
+    """
+    return _registry
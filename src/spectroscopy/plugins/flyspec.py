@@ -2,9 +2,7 @@
 Plugin to read FlySpec data.
 """
 from functools import partial
-import datetime
 import os
-import struct
 
 import numpy as np
 
@@ -22,20 +20,47 @@ class FlySpecPluginException(Exception):
     pass
 
 
+def read_spectra(fin, channels=2048, byteorder='='):
+    """
+    Read spectra from a FlySpec binary file.
+
+    The file holds one record of `channels` 32 bit floats per spectrum.
+    It is memory mapped rather than read so spectra are only copied once,
+    when they are converted to a buffer.
+
+    :type fin: str
+    :param fin: Path to the binary file.
+    :type channels: int
+    :param channels: Number of channels per spectrum.
+    :type byteorder: str
+    :param byteorder: Byte order of the floats, '<' for little endian,
+        '>' for big endian or '=' for the byte order of this machine.
+    :rtype: :class:`numpy.ndarray`
+    :returns: Read-only array of shape (number of spectra, channels).
+    """
+    if byteorder not in ('<', '>', '='):
+        msg = "byteorder has to be one of '<', '>' or '='."
+        raise ValueError(msg)
+    dtype = np.dtype(byteorder + 'f4')
+    record = channels * dtype.itemsize
+    size = os.path.getsize(fin)
+    if size % record != 0:
+        msg = "{} does not contain whole spectra of {:d} channels."
+        raise FlySpecPluginException(msg.format(fin, channels))
+    if size == 0:
+        # empty files cannot be mapped
+        return np.empty((0, channels), dtype=dtype)
+    return np.memmap(fin, dtype=dtype, mode='r',
+                     shape=(size // record, channels))
+
+
 class FlySpecPlugin(DatasetPluginBase):
 
-    def _read_spectra(self, fin):
+    def _read_spectra(self, fin, channels=2048, byteorder='='):
         """
         Read spectra from binary file.
         """
-        with open(fin, "rb") as ifp:
-            raw_data = ifp.read()
-        i = 0
-        counts = []
-        while i < len(raw_data):
-            counts.append(struct.unpack("2048f", raw_data[i:i+(2048 * 4)]))
-            i += (2048 * 4)
-        return counts
+        return read_spectra(fin, channels=channels, byteorder=byteorder)
 
     def read(self, dataset, filename, timeshift=0, **kargs):
         """
@@ -45,6 +70,12 @@ class FlySpecPlugin(DatasetPluginBase):
         :type timeshift: FlySpecs record data in local time so a timeshift in
             hours of local time with respect to UTC can be given. For example
             `timeshift=12.00` will subtract 12 hours from the recorded time.
+        :type channels: int
+        :param channels: Number of channels of the spectra in the binary
+            file given as `spectra`. Defaults to 2048.
+        :type byteorder: str
+        :param byteorder: Byte order of the spectra, see
+            :func:`read_spectra`.
 
         """
         # load data and convert southern hemisphere to negative
@@ -79,7 +110,9 @@ class FlySpecPlugin(DatasetPluginBase):
         if specfile is not None:
             wavelengths = kargs.get('wavelengths', None)
             if wavelengths is not None:
-                spectra = np.array(self._read_spectra(specfile))
+                spectra = self._read_spectra(
+                    specfile, channels=kargs.get('channels', 2048),
+                    byteorder=kargs.get('byteorder', '='))
                 if spectra.shape[0] != data.shape[0]:
                     raise FlySpecPluginException(
                         "Spectra and concentration don't have the same shape.")
@@ -105,10 +138,16 @@ class FlySpecPlugin(DatasetPluginBase):
         # convert decimal seconds to microseconds
         int_times[:, 6] = (data[:, 6] - int_times[:, 5]) * 1e6
         # ToDo: handle timezones properly
-        times = [datetime.datetime(*int_times[i, :]) +
-                 datetime.timedelta(seconds=ts)
-                 for i in range(int_times.shape[0])]
-        unix_times = [i.isoformat() for i in times]
+        times = ((int_times[:, 0] - 1970).astype('datetime64[Y]')
+                 .astype('datetime64[M]')
+                 + (int_times[:, 1] - 1).astype('timedelta64[M]'))
+        times = (times.astype('datetime64[D]')
+                 + (int_times[:, 2] - 1).astype('timedelta64[D]')
+                 + int_times[:, 3].astype('timedelta64[h]')
+                 + int_times[:, 4].astype('timedelta64[m]')
+                 + int_times[:, 5].astype('timedelta64[s]')
+                 + int_times[:, 6].astype('timedelta64[us]')
+                 + np.timedelta64(int(round(ts * 1e6)), 'us'))
         latitude = data[:, 8] * data[:, 9]
         longitude = data[:, 10] * data[:, 11]
         elevation = data[:, 12]
@@ -120,7 +159,7 @@ class FlySpecPlugin(DatasetPluginBase):
                                position=np.array([longitude,
                                                   latitude,
                                                   elevation]).T,
-                               datetime=unix_times,
+                               datetime=times,
                                ind_var=wavelengths,
                                d_var=spectra)
         else:
@@ -128,7 +167,7 @@ class FlySpecPlugin(DatasetPluginBase):
                                position=np.array([longitude,
                                                   latitude,
                                                   elevation]).T,
-                               datetime=unix_times)
+                               datetime=times)
         rdtb = RawDataTypeBuffer(d_var_unit='ppm m',
                                  ind_var_unit='nm', name='measurement')
         cb = ConcentrationBuffer(gas_species='SO2', value=so2)
@@ -161,7 +200,7 @@ class FlySpecFluxPlugin(DatasetPluginBase):
         f = data['flux']
 
         mb = MethodBuffer(name='GNS FlySpec UI')
-        fb = FluxBuffer(value=f, datetime=dtn.astype(str))
+        fb = FluxBuffer(value=f, datetime=dtn)
         return {str(fb): fb, str(mb): mb}
 
     @staticmethod
@@ -171,22 +210,17 @@ class FlySpecFluxPlugin(DatasetPluginBase):
 
 class FlySpecRefPlugin(DatasetPluginBase):
 
-    def _read_spectra(self, fin):
+    def _read_spectra(self, fin, channels=2048, byteorder='='):
         """
         Read spectra from binary file.
         """
-        with open(fin, "rb") as ifp:
-            raw_data = ifp.read()
-        i = 0
-        counts = []
-        while i < len(raw_data):
-            counts.append(struct.unpack("2048f", raw_data[i:i+(2048 * 4)]))
-            i += (2048 * 4)
-        return counts
+        return read_spectra(fin, channels=channels, byteorder=byteorder)
 
     def read(self, dataset, filename,  **kargs):
         """
-        Read reference spectra for FlySpec.
+        Read reference spectra for FlySpec. The number of channels and
+        the byte order of the file can be given as `channels` and
+        `byteorder`, see :func:`read_spectra`.
         """
         try:
             wavelengths = kargs['wavelengths']
@@ -195,7 +229,9 @@ class FlySpecRefPlugin(DatasetPluginBase):
             msg = 'Please provide wavelengths and measurement type.'
             raise FlySpecPluginException(msg)
 
-        spectra = np.array(self._read_spectra(filename))
+        spectra = self._read_spectra(
+            filename, channels=kargs.get('channels', 2048),
+            byteorder=kargs.get('byteorder', '='))
         if spectra.shape[1] != wavelengths.size:
             msg = "Spectra and wavelengths don't have the same size."
             raise FlySpecPluginException(msg)
@@ -251,11 +287,14 @@ class FlySpecWindPlugin(DatasetPluginBase):
         mb = MethodBuffer(name='some model')
         m = dataset.new(mb)
         gfb = GasFlowBuffer(methods=[m], vx=vx, vy=vy, vz=vz,
-                            position=position, datetime=dt.astype(str),
+                            position=position, datetime=dt,
                             user_notes=description, unit='m/s')
         gf = dataset.new(gfb)
         return gf
 
+    def needs_dataset(self, **kargs):
+        return True
+
     @staticmethod
     def get_format():
         return 'flyspecwind'
@@ -3,7 +3,8 @@ Plugin to read MiniDOAS data.
 """
 import codecs
 import datetime
-import io
+import itertools
+import warnings
 
 import numpy as np
 import pyproj
@@ -15,29 +16,112 @@ from spectroscopy.datamodel import (RawDataBuffer,
                                     MethodBuffer,
                                     GasFlowBuffer)
 from spectroscopy.plugins import DatasetPluginBase, DatasetPluginBaseException
-from spectroscopy.util import bearing2vec
+from spectroscopy.util import bearing2vec, nearest_index
 
 
-def find_bad_lines(filename, **loadtxt_kargs):
+def read_tolerant(filename, dtype, delimiter=',', skiprows=1,
+                  converters=None):
     """
-    Find lines that are not properly formatted and
-    return a clean buffer.
+    Read a delimited text file into a structured array, skipping lines
+    that don't have one value of the right type for every field.
+
+    The file is read once. Lines with the wrong number of fields are
+    dropped and the rest is parsed in bulk, skipping over lines with
+    values that can't be converted.
+
+    :type filename: str
+    :param filename: Path to the file.
+    :type dtype: :class:`numpy.dtype`
+    :param dtype: Structured data type with one scalar field per column.
+    :type delimiter: str
+    :param delimiter: String separating the columns.
+    :type skiprows: int
+    :param skiprows: Number of header lines to skip.
+    :type converters: dict
+    :param converters: Functions converting the string of a column, given
+        by its index, before it is assigned to its field. A ValueError
+        rejects the line.
+    :rtype: tuple
+    :returns: The structured array and a list of the numbers of rejected
+        lines, counting from 1.
     """
-    master = io.StringIO()
-    with open(filename) as fh:
-        lines = fh.readlines()
-        for _l in lines[1:]:
-            fs = io.StringIO()
-            fs.write(str(_l))
-            fs.seek(0)
+    dtype = np.dtype(dtype)
+    converters = converters or {}
+    with open(filename, encoding='utf-8-sig', errors='ignore') as fh:
+        lines = fh.read().splitlines()
+
+    # Lines with the wrong number of fields are rejected first
+    lines = lines[skiprows:]
+    nsep = len(dtype.names) - 1
+    counts = np.array([line.count(delimiter) for line in lines], dtype=int)
+    good = counts == nsep
+    rejected = [int(i) + skiprows + 1 for i in np.flatnonzero(~good)
+                if lines[i].strip()]
+    linenos = np.flatnonzero(good) + skiprows + 1
+    kept = [lines[i] for i in np.flatnonzero(good)]
+
+    # Columns with a converter are parsed as strings and converted after
+    # the bad lines have been removed, so converters run once per line.
+    raw_dtype = np.dtype([(name, object if i in converters else dtype[name])
+                          for i, name in enumerate(dtype.names)])
+
+    # Usually all remaining lines are fine and are parsed in one go.
+    # Otherwise the lines are bisected until the bad ones are isolated.
+    chunks = []
+    pending = [(0, len(kept))] if kept else []
+    while pending:
+        start, stop = pending.pop()
+        try:
+            chunks.append((start, stop, np.loadtxt(
+                kept[start:stop], dtype=raw_dtype, delimiter=delimiter,
+                comments=None, encoding=None, ndmin=1)))
+        except ValueError:
+            if stop - start == 1:
+                rejected.append(int(linenos[start]))
+                continue
+            middle = (start + stop) // 2
+            pending.extend([(middle, stop), (start, middle)])
+    chunks.sort(key=lambda c: c[0])
+    raw = np.concatenate([c[2] for c in chunks] +
+                         [np.zeros(0, dtype=raw_dtype)])
+    rows = [np.arange(c[0], c[1]) for c in chunks]
+    linenos = linenos[np.concatenate(rows + [np.zeros(0, dtype=int)])]
+
+    valid = np.ones(raw.size, dtype=bool)
+    columns = {}
+    for i, convert in converters.items():
+        name = dtype.names[i]
+        try:
+            columns[name] = np.array([convert(v) for v in raw[name]],
+                                     dtype=dtype[name])
+            continue
+        except (ValueError, TypeError):
+            pass
+        # find the values that can't be converted
+        fill = np.zeros(1, dtype=dtype[name])[0]
+        column = []
+        for j, value in enumerate(raw[name]):
             try:
-                np.loadtxt(fs, **loadtxt_kargs)
-            except ValueError:
-                pass
-            else:
-                master.write(str(_l))
-    master.seek(0)
-    return master
+                value = convert(value)
+                np.array(value, dtype=dtype[name])
+            except (ValueError, TypeError):
+                valid[j] = False
+                value = fill
+            column.append(value)
+        columns[name] = np.array(column, dtype=dtype[name])
+
+    data = np.zeros(int(valid.sum()), dtype=dtype)
+    for name in dtype.names:
+        data[name] = columns.get(name, raw[name])[valid]
+    rejected.extend(linenos[~valid].tolist())
+    return data, sorted(rejected)
+
+
+def _warn_rejected(filename, rejected):
+    if rejected:
+        msg = "Skipped malformed lines of {}: {}"
+        warnings.warn(msg.format(filename,
+                                 ', '.join(str(i) for i in rejected)))
 
 
 class MiniDoasException(DatasetPluginBaseException):
@@ -46,55 +130,130 @@ class MiniDoasException(DatasetPluginBaseException):
 
 class MiniDoasRaw(DatasetPluginBase):
 
-    def read(self, dataset, filename, timeshift=0, **kargs):
-
-        fh = codecs.open(filename, encoding='utf-8-sig', errors='ignore')
-        for line in fh.readlines():
-            a = line.encode('utf-8')
-            if a == b'\x00'*len(a):
-                fh.close()
-                msg = "File {} contains line of binary 0's"
-                raise MiniDoasException(msg.format(filename))
-        fh.seek(0)
-        dt = np.dtype([('station', 'S2'), ('date', 'S10'), ('time', np.float),
-                       ('stept', np.int), ('angle', np.float),
-                       ('intt', np.int), ('nspec', np.int),
-                       ('specin', np.float), ('counts', np.int, (482,))])
-
-        def date_converter(x):
-            y = x.decode('ascii')
-            return '%s-%s-%s' % (y[0:4], y[4:6], y[6:8])
-
-        data = np.loadtxt(fh, converters={1: date_converter},
-                          dtype=dt, delimiter=',', ndmin=1)
-        fh.close()
-        # Construct datetimes
-        date = data['date'].astype('datetime64')
-        hours = (data['time']/3600.).astype(int)
-        minutes = ((data['time'] - hours*3600.)/60.).astype(int)
-        fseconds = data['time'] - hours*3600. - minutes*60.
-        iseconds = (fseconds).astype(int)
-        mseconds = np.round((fseconds - iseconds), 3)*1e3
-        datetime = date + hours.astype('timedelta64[h]') \
-            + minutes.astype('timedelta64[m]') \
-            + iseconds.astype('timedelta64[s]') \
-            + mseconds.astype('timedelta64[ms]')
-        datetime -= np.timedelta64(int(timeshift), 'h')
-
-        # Convert radians to decimal degrees
-        angles = data['angle']*360./(2.*np.pi)
+    # Columns of a raw data file
+    dtype = np.dtype([('station', 'S2'), ('date', int), ('time', float),
+                      ('stept', int), ('angle', float), ('intt', int),
+                      ('nspec', int), ('specin', float),
+                      ('counts', int, (482,))])
+
+    def _chunks(self, filename, chunksize):
+        """
+        Parse a raw data file in chunks of `chunksize` lines. Yields the
+        datetimes, the angles in radians, the integration times and the
+        counts of each chunk.
+        """
+        with open(filename, 'rb') as fh:
+            first = True
+            while True:
+                lines = list(itertools.islice(fh, chunksize))
+                if not lines:
+                    return
+                if first:
+                    lines[0] = lines[0][len(codecs.BOM_UTF8):] \
+                        if lines[0].startswith(codecs.BOM_UTF8) else lines[0]
+                    first = False
+                for line in lines:
+                    a = line.rstrip(b'\r\n')
+                    if a and not a.strip(b'\x00'):
+                        msg = "File {} contains line of binary 0's"
+                        raise MiniDoasException(msg.format(filename))
+                data = np.loadtxt([line.decode('utf-8', 'ignore')
+                                   for line in lines],
+                                  dtype=self.dtype, delimiter=',', ndmin=1)
+                if data.size == 0:
+                    continue
+                # Construct datetimes from the date as YYYYMMDD and the
+                # seconds since midnight
+                year, rest = np.divmod(data['date'], 10000)
+                month, day = np.divmod(rest, 100)
+                date = ((year - 1970).astype('datetime64[Y]')
+                        .astype('datetime64[M]')
+                        + (month - 1).astype('timedelta64[M]'))
+                date = (date.astype('datetime64[D]')
+                        + (day - 1).astype('timedelta64[D]'))
+                hours = (data['time']/3600.).astype(int)
+                minutes = ((data['time'] - hours*3600.)/60.).astype(int)
+                fseconds = data['time'] - hours*3600. - minutes*60.
+                iseconds = (fseconds).astype(int)
+                mseconds = np.round((fseconds - iseconds), 3)*1e3
+                datetime = date + hours.astype('timedelta64[h]') \
+                    + minutes.astype('timedelta64[m]') \
+                    + iseconds.astype('timedelta64[s]') \
+                    + mseconds.astype('timedelta64[ms]')
+                yield datetime, data['angle'], data['intt'], data['counts']
+
+    def read(self, dataset, filename, timeshift=0, chunksize=None, **kargs):
+        """
+        Read a raw data file.
+
+        :type chunksize: int
+        :param chunksize: If given, the file is streamed into `dataset`
+            `chunksize` lines at a time, so memory use does not depend on
+            the size of the file. The first chunk creates a new RawData
+            element and the following chunks are appended to it. The
+            RawData element can be given an `instrument`, a `target` and a
+            `type`; without a `type` a new RawDataType element is created.
+            If a line of binary 0's is found the lines before it have
+            already been written. Otherwise the whole file is parsed into
+            buffers.
+        :rtype: dict
+        :returns: The buffers or, when streaming, the elements keyed by
+            their class name.
+        """
         rdtb = RawDataTypeBuffer(d_var_unit='ppm-m',
                                  ind_var_unit='nm',
                                  name='measurement',
                                  acquisition='stationary')
         wavelengths = np.arange(30, 512)
-        rb = RawDataBuffer(inc_angle=angles,
-                           datetime=datetime.astype(str),
-                           ind_var=wavelengths,
-                           d_var=data['counts'],
-                           integration_time=data['intt'])
+        ts = np.timedelta64(int(timeshift), 'h')
+
+        if chunksize is None:
+            chunks = list(self._chunks(filename, 10000))
+            if chunks:
+                datetime, angles, intt, counts = \
+                    [np.concatenate(c) for c in zip(*chunks)]
+            else:
+                datetime = np.empty(0, dtype='datetime64[ms]')
+                angles = np.empty(0)
+                intt = np.empty(0, dtype=int)
+                counts = np.empty((0, wavelengths.size), dtype=int)
+            # Convert radians to decimal degrees
+            rb = RawDataBuffer(inc_angle=angles*360./(2.*np.pi),
+                               datetime=datetime - ts,
+                               ind_var=wavelengths,
+                               d_var=counts,
+                               integration_time=intt)
+            return {str(rb): rb, str(rdtb): rdtb}
+
+        if dataset is None:
+            msg = "Streaming a file requires a dataset."
+            raise MiniDoasException(msg)
+        rdt = kargs.get('type')
+        if rdt is None:
+            rdt = dataset.new(rdtb)
+        r = None
+        for datetime, angles, intt, counts in self._chunks(filename,
+                                                           chunksize):
+            rb = RawDataBuffer(inc_angle=angles*360./(2.*np.pi),
+                               datetime=datetime - ts,
+                               d_var=counts,
+                               integration_time=intt)
+            if r is None:
+                rb.ind_var = wavelengths
+                rb.type = rdt
+                for name in ('instrument', 'target'):
+                    if kargs.get(name) is not None:
+                        setattr(rb, name, kargs[name])
+                r = dataset.new(rb)
+            else:
+                r.append(rb)
+        result = {str(rdt): rdt}
+        if r is not None:
+            result[str(r)] = r
+        return result
 
-        return {str(rb): rb, str(rdtb): rdtb}
+    def needs_dataset(self, chunksize=None, **kargs):
+        return chunksize is not None
 
     @staticmethod
     def get_format():
@@ -124,7 +283,7 @@ class MiniDoasSpectra(DatasetPluginBase):
         else:
             c = data['value']
         cb = ConcentrationBuffer(value=c,
-                                 datetime=dtm.astype(str),
+                                 datetime=dtm,
                                  gas_species='SO2',
                                  unit='ppm-m')
         return {str(cb): cb}
@@ -163,7 +322,7 @@ class MiniDoasScan(DatasetPluginBase):
         mb = MethodBuffer(name='WS2PV', description=description)
         gfb = GasFlowBuffer(vx=vx, vy=vy, vz=vz,
                             position=position,
-                            datetime=np.array(time).astype(str),
+                            datetime=np.array(time),
                             unit='m/s')
         return (mb, gfb)
 
@@ -176,27 +335,19 @@ class MiniDoasScan(DatasetPluginBase):
         station = kargs.get('station', None)
 
         def dateconverter(x):
-            return date+'T'+x.decode('ascii')
-
-        dt = np.dtype([('time', 'U19'), ('ws', np.float), ('wd', np.float),
-                       ('R2', np.float), ('SO2Start', np.float),
-                       ('SO2Max', np.float), ('SO2End', np.float),
-                       ('PlumeRange', np.float), ('PlumeWidth', np.float),
-                       ('PlumeHeight', np.float), ('Easting', np.float),
-                       ('Northing', np.float), ('Track', np.float),
-                       ('Emission', np.float), ('Station', 'U2'),
-                       ('EmissionSE', np.float)])
-        try:
-            data = np.loadtxt(filename, delimiter=',', skiprows=1, dtype=dt,
-                              converters={0: dateconverter},
-                              ndmin=1)
-        except ValueError:
-            buf = find_bad_lines(filename, delimiter=',', dtype=dt,
-                                 converters={0: dateconverter},
-                                 ndmin=1)
-            data = np.loadtxt(buf, delimiter=',', dtype=dt,
-                              converters={0: dateconverter},
-                              ndmin=1)
+            return date+'T'+x
+
+        dt = np.dtype([('time', 'U19'), ('ws', float), ('wd', float),
+                       ('R2', float), ('SO2Start', float),
+                       ('SO2Max', float), ('SO2End', float),
+                       ('PlumeRange', float), ('PlumeWidth', float),
+                       ('PlumeHeight', float), ('Easting', float),
+                       ('Northing', float), ('Track', float),
+                       ('Emission', float), ('Station', 'U2'),
+                       ('EmissionSE', float)])
+        data, rejected = read_tolerant(filename, dt, delimiter=',',
+                                       converters={0: dateconverter})
+        _warn_rejected(filename, rejected)
 
         if station is not None:
             idx = np.where(data['Station'] == station)
@@ -206,7 +357,7 @@ class MiniDoasScan(DatasetPluginBase):
         dtm -= np.timedelta64(int(timeshift), 'h')
         fb = FluxBuffer(value=data['Emission'][idx]/86.4,
                         value_error=data['EmissionSE'][idx]/86.4,
-                        datetime=dtm.astype(str))
+                        datetime=dtm)
         mb, gfb = self._plumegeometry2gasflow(data['ws'][idx],
                                               data['PlumeHeight'][idx],
                                               data['PlumeWidth'][idx],
@@ -234,64 +385,46 @@ class MiniDoasWind(DatasetPluginBase):
             raise MiniDoasException(msg)
 
         def dateconverter(x):
-            return (datetime.datetime.strptime(x.decode('ascii'),
-                                               '%d/%m/%Y %H:%M:%S')
+            return (datetime.datetime.strptime(x, '%d/%m/%Y %H:%M:%S')
                     .strftime('%Y-%m-%dT%H:%M:%S'))
 
-        try:
-            dtp1 = np.dtype([('datetime', 'S19'), ('direction', np.float)])
-            data1 = np.loadtxt(fn_wd, skiprows=1, dtype=dtp1, delimiter='\t',
-                               converters={0: dateconverter}, ndmin=1)
-        except ValueError:
-            buf = find_bad_lines(fn_wd, dtype=dtp1, delimiter='\t',
-                                 converters={0: dateconverter}, ndmin=1)
-            data1 = np.loadtxt(buf, dtype=dtp1, delimiter='\t',
-                               converters={0: dateconverter}, ndmin=1)
-
-        try:
-            dtp2 = np.dtype([('datetime', 'S19'), ('speed', np.float)])
-            data2 = np.loadtxt(fn_ws, skiprows=1, dtype=dtp2, delimiter='\t',
-                               converters={0: dateconverter}, ndmin=1)
-        except ValueError:
-            buf = find_bad_lines(fn_ws, dtype=dtp2, delimiter='\t',
-                                 converters={0: dateconverter}, ndmin=1)
-            data2 = np.loadtxt(buf, dtype=dtp2, delimiter='\t',
-                               converters={0: dateconverter}, ndmin=1)
+        dtp1 = np.dtype([('datetime', 'S19'), ('direction', float)])
+        data1, rejected = read_tolerant(fn_wd, dtp1, delimiter='\t',
+                                        converters={0: dateconverter})
+        _warn_rejected(fn_wd, rejected)
+        dtp2 = np.dtype([('datetime', 'S19'), ('speed', float)])
+        data2, rejected = read_tolerant(fn_ws, dtp2, delimiter='\t',
+                                        converters={0: dateconverter})
+        _warn_rejected(fn_ws, rejected)
 
         # Some of the wind data files have been created
         # by hand because the weather station didn't
         # send any data. They then may have different
         # number of entries, hence we have to find the
         # matching times
-        dates = []
-        vx = []
-        vy = []
-        vz = []
-        for i, _d in enumerate(data1['datetime'].astype("datetime64[s]")):
-            tdiff = np.abs(_d - data2['datetime'].astype("datetime64[s]"))
-            idx = np.argmin(tdiff)
-            if tdiff.astype('int').min() > 1:
-                continue
-            wd = data1['direction'][i]
-            ws = data2['speed'][idx]
-            # if windspeed is 0 give it a tiny value
-            # so that the bearing can be reconstructed
-            if ws == 0.:
-                ws = 0.0001
-            _vx, _vy = bearing2vec(wd, ws)
-            vx.append(_vx)
-            vy.append(_vy)
-            vz.append(np.nan)
-            dates.append(_d)
-        dtm = np.array(dates, dtype="datetime64[s]")
+        dates = data1['datetime'].astype("datetime64[s]")
+        idx, within = nearest_index(dates,
+                                    data2['datetime'].astype("datetime64[s]"),
+                                    tolerance=np.timedelta64(1, 's'))
+        wd = data1['direction'][within]
+        ws = data2['speed'][idx[within]]
+        # if windspeed is 0 give it a tiny value
+        # so that the bearing can be reconstructed
+        ws = np.where(ws == 0., 0.0001, ws)
+        vx, vy = bearing2vec(wd, ws)
+        vz = np.full(vx.shape, np.nan)
+        dtm = dates[within]
         dtm -= np.timedelta64(int(timeshift), 'h')
         description = 'Autonomous weather station operated by NZ metservice'
         mb = MethodBuffer(name='AWS', description=description)
         m = dataset.new(mb)
         gfb = GasFlowBuffer(methods=[m], vx=vx, vy=vy, vz=vz,
-                            datetime=dtm.astype(str), unit='m/s')
+                            datetime=dtm, unit='m/s')
         return {str(gfb): gfb}
 
+    def needs_dataset(self, **kargs):
+        return True
+
     @staticmethod
     def get_format():
         return 'minidoas-wind'
@@ -180,6 +180,9 @@ class NZMetservicePlugin(DatasetPluginBase):
         gf = dataset.new(gfb)
         return gf
 
+    def needs_dataset(self, **kargs):
+        return True
+
     @staticmethod
     def get_format():
         return 'nzmetservice'
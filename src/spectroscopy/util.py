@@ -11,6 +11,9 @@ def bearing2vec(bearing, norm=1.0):
     bearing given unless norm is not 1.0. Bearing in this sense refers to angle
     clockwise from the direction [0, 1].
     So, for example: bearing2vec(90) -> [1, 0]
+    Bearings and norms can also be arrays, in which case the result has
+    shape (2, n) so that ``x, y = bearing2vec(bearings, norms)`` works for
+    both.
 
     >>> bearing2vec(90)
     array([  1.00000000e+00,   6.12323400e-17])
@@ -18,31 +21,71 @@ def bearing2vec(bearing, norm=1.0):
     array([ 0.70710678,  0.70710678])
     >>> bearing2vec(30,3.0)
     array([ 1.5       ,  2.59807621])
+    >>> bearing2vec([90, 30], [1.0, 3.0]).round(8)
+    array([[1.        , 1.5       ],
+           [0.        , 2.59807621]])
     """
-    if bearing >= 180:
-        x_sign = -1
-        if bearing < 270:
-            y_sign = -1
-            bearing -= 180
-        else:
-            y_sign = 1
-            bearing = 360 - bearing
-    elif bearing > 90:
-        y_sign = -1
-        x_sign = 1
-        bearing = bearing - 90
-    else:
-        y_sign = 1
-        x_sign = 1
+    bearing = np.asarray(bearing, dtype=float)
+    x_sign = np.where(bearing >= 180, -1., 1.)
+    y_sign = np.where((bearing > 90) & (bearing < 270), -1., 1.)
+    bearing = np.select([bearing >= 270, bearing >= 180, bearing > 90],
+                        [360 - bearing, bearing - 180, bearing - 90],
+                        bearing)
 
-    assert bearing <= 90
+    assert np.all(bearing <= 90)
 
-    y = y_sign * math.cos(math.radians(bearing)) * norm
-    x = x_sign * math.sin(math.radians(bearing)) * norm
+    y = y_sign * np.cos(np.radians(bearing)) * norm
+    x = x_sign * np.sin(np.radians(bearing)) * norm
 
     return np.array([x, y])
 
 
+def nearest_index(values, reference, tolerance=None):
+    """
+    Find for every value the index of the closest value in reference.
+    Works for numbers and datetime64 arrays and neither array has to be
+    sorted. Of equally close values in reference the first one is chosen.
+
+    >>> nearest_index([1, 4, 10], [0, 3, 5, 9], tolerance=1)
+    (array([0, 1, 3]), array([ True,  True,  True]))
+    >>> nearest_index([1, 20], [5, 0, 0])
+    (array([1, 0]), array([ True,  True]))
+
+    :type values: :class:`numpy.ndarray`
+    :param values: Values to look up.
+    :type reference: :class:`numpy.ndarray`
+    :param reference: Values to search.
+    :param tolerance: Largest difference between a value and its match.
+    :rtype: tuple
+    :returns: The indices into reference and a boolean array that is False
+        where the closest value is further away than tolerance.
+    """
+    values = np.asarray(values)
+    reference = np.asarray(reference)
+    if reference.size == 0:
+        return (np.zeros(values.shape, dtype=int),
+                np.zeros(values.shape, dtype=bool))
+    order = np.argsort(reference, kind='stable')
+    ref = reference[order]
+    right = np.searchsorted(ref, values, side='left')
+    left = np.maximum(right - 1, 0)
+    right = np.minimum(right, ref.size - 1)
+    # go back to the first of equal values
+    left = np.searchsorted(ref, ref[left], side='left')
+    dleft = np.abs(values - ref[left])
+    dright = np.abs(ref[right] - values)
+    # of equally close values the one coming first in reference wins
+    use_left = (dleft < dright) | ((dleft == dright) &
+                                   (order[left] <= order[right]))
+    idx = np.where(use_left, left, right)
+    diff = np.where(use_left, dleft, dright)
+    if tolerance is None:
+        within = np.ones(values.shape, dtype=bool)
+    else:
+        within = diff <= tolerance
+    return order[idx], within
+
+
 def vec2bearing(vx, vy):
     """
     Compute the angle clockwise from the direction [0, 1] from the given x and
@@ -191,23 +234,25 @@ def get_wind_speed(gf, lon, lat, elev, date):
     _t = np.atleast_2d(_dt).T
     # TODO: this needs to be changed to account for regular and irregular
     # grids
-    a = np.append(gf.position[:], _t.astype('float'), axis=1)
+    _pos = gf.position[:]
+    a = np.append(_pos, _t.astype('float'), axis=1)
     tree = KDTree(a, leafsize=a.shape[0] + 1)
     point = [lon, lat, elev, _ts]
     distances, ndx = tree.query([point], k=1)
-    vx = gf.vx[:][ndx[0]]
-    vy = gf.vy[:][ndx[0]]
-    vz = gf.vz[:][ndx[0]]
+    # only read the rows we need from the wind components
+    vx = gf.vx[ndx[0]]
+    vy = gf.vy[ndx[0]]
+    vz = gf.vz[ndx[0]]
     try:
-        vx_error = gf.vx_error[:][ndx[0]]
-        vy_error = gf.vy_error[:][ndx[0]]
-        vz_error = gf.vz_error[:][ndx[0]]
+        vx_error = gf.vx_error[ndx[0]]
+        vy_error = gf.vy_error[ndx[0]]
+        vz_error = gf.vz_error[ndx[0]]
     except TypeError:
         vx_error = None
         vy_error = None
         vz_error = None
-    time = gf.datetime[:][ndx[0]]
-    lon, lat, hght = gf.position[:][ndx[0], :]
+    time = _dt[ndx[0]]
+    lon, lat, hght = _pos[ndx[0], :]
     return (lon, lat, hght, time, vx, vx_error,
             vy, vy_error, vz, vz_error, distances[0])
 
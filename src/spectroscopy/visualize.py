@@ -13,6 +13,7 @@ import cartopy.crs as ccrs
 from cartopy.io.img_tiles import StamenTerrain
 import pyproj
 
+from spectroscopy.class_factory import _time_window
 from spectroscopy.util import split_by_scan, vec2bearing
 
 
@@ -58,9 +59,10 @@ def plot_concentration(c, savefig=None, angle_bin=1.0, **kargs):
     ymin = angle_bins[-1]
     ymax = angle_bins[0]
     nretrieval = 0
-    for _angle, _so2, _t in split_by_scan(r.inc_angle[c.rawdata_indices[:]],
+    rdi = c.rawdata_indices[:]
+    for _angle, _so2, _t in split_by_scan(r.inc_angle[rdi],
                                           c.value[:],
-                                          r.datetime[c.rawdata_indices[:]]):
+                                          r.datetime[rdi]):
         ymin = min(_angle.min(), ymin)
         ymax = max(_angle.max(), ymax)
         times.append(_t)
@@ -110,10 +112,10 @@ def plot_rawdata(r, savefig=None, **kargs):
     except KeyError:
         idx = np.arange(r.d_var.shape[0])
     else:
+        if getattr(r, '_write_behind', None) is not None:
+            r._write_behind.flush(r)
         try:
-            dt = r.datetime[:].astype('datetime64[ms]')
-            idx = np.where(((dt > np.datetime64(dmin))
-                            & (dt < np.datetime64(dmax))))[0]
+            idx = _time_window(r._root.datetime, dmin, dmax, exclusive=True)
         except tables.NoSuchNodeError:
             idx = np.arange(r.d_var.shape[0])
     counts = r.d_var[idx, :]
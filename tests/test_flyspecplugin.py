@@ -2,6 +2,7 @@ import datetime
 import glob
 import inspect
 import os
+import struct
 import tempfile
 import unittest
 
@@ -15,6 +16,7 @@ from scipy.interpolate import interp1d
 from spectroscopy.dataset import Dataset
 from spectroscopy.plugins.flyspec import FlySpecPlugin
 from spectroscopy.plugins.flyspec import FlySpecPluginException
+from spectroscopy.plugins.flyspec import read_spectra
 from spectroscopy.util import split_by_scan, _array_multi_sort, vec2bearing
 from spectroscopy.visualize import plot
 from spectroscopy.datamodel import (InstrumentBuffer,
@@ -241,6 +243,44 @@ class FlySpecPluginTestCase(unittest.TestCase):
                 rms = self.compare_images(fd, expected_image)
                 self.assertTrue(rms <= 0.001)
 
+    def test_read_spectra(self):
+        """
+        Test reading binary spectra files.
+        """
+        fin = os.path.join(self.data_dir, 'TOFP04',
+                           'Cal_20170602_0956_high.bin')
+        with open(fin, 'rb') as fh:
+            raw = fh.read()
+        expected = np.array([struct.unpack('2048f', raw[i:i + 8192])
+                             for i in range(0, len(raw), 8192)])
+        spectra = read_spectra(fin)
+        self.assertEqual(spectra.shape, (10, 2048))
+        np.testing.assert_array_equal(spectra, expected)
+        spectra = read_spectra(fin, channels=1024)
+        self.assertEqual(spectra.shape, (20, 1024))
+        with self.assertRaises(FlySpecPluginException):
+            read_spectra(fin, channels=2047)
+        with self.assertRaises(ValueError):
+            read_spectra(fin, byteorder='big')
+
+        # Files written on a machine of the other byte order
+        fn = tempfile.mktemp()
+        swapped = '>' if np.little_endian else '<'
+        expected.astype(swapped + 'f4').tofile(fn)
+        np.testing.assert_array_equal(read_spectra(fn, byteorder=swapped),
+                                      expected)
+        open(fn, 'wb').close()
+        self.assertEqual(read_spectra(fn).shape, (0, 2048))
+        os.remove(fn)
+
+        d = Dataset(tempfile.mktemp(), 'w')
+        e = d.read(fin, ftype='flyspecref', wavelengths=np.arange(512.),
+                   type='high', channels=512)
+        self.assertEqual(e['RawDataBuffer'].d_var.shape, (40, 512))
+        r = d.new(e['RawDataBuffer'])
+        np.testing.assert_array_equal(r.d_var[:].reshape(10, 2048), expected)
+        d.close()
+
     def test_readabunch(self):
         """
         Read in a whole day's worth of data including the reference spectra,
@@ -1,12 +1,15 @@
+import codecs
+import datetime
 import inspect
 import os
 import tempfile
 import unittest
+import warnings
 
 import numpy as np
 
 from spectroscopy.dataset import Dataset
-from spectroscopy.plugins.minidoas import MiniDoasException
+from spectroscopy.plugins.minidoas import MiniDoasException, read_tolerant
 from spectroscopy.datamodel import (PreferredFluxBuffer,
                                     InstrumentBuffer,
                                     TargetBuffer,
@@ -33,6 +36,99 @@ class MiniDoasPluginTestCase(unittest.TestCase):
                                 'SR_20170328_non_utf8_line.csv'),
                    ftype='minidoas-raw')
 
+    def test_stream(self):
+        """
+        Test streaming raw data files into a dataset in chunks.
+        """
+        with open(os.path.join(self.data_dir,
+                               'SR_20170328_non_utf8_line.csv'), 'rb') as fh:
+            lines = fh.readlines()
+        good, zeros = lines[:-1], lines[-1]
+        # only the first line starts with a byte order mark
+        good[0] = good[0].replace(codecs.BOM_UTF8, b'')
+        fn = tempfile.mktemp()
+        with open(fn, 'wb') as fh:
+            fh.write(codecs.BOM_UTF8)
+            fh.writelines(good * 4)
+
+        d = Dataset(tempfile.mktemp(), 'w')
+        rb = d.read(fn, ftype='minidoas-raw', timeshift=13)['RawDataBuffer']
+        self.assertEqual(rb.d_var.shape, (220, 482))
+        self.assertEqual(rb.datetime[0],
+                         np.datetime64('2017-03-27T20:00:00.100'))
+        i = d.new(InstrumentBuffer(name='SR'))
+        e = d.read(fn, ftype='minidoas-raw', timeshift=13, chunksize=50,
+                   instrument=i)
+        r = e['RawData']
+        self.assertEqual(r.type, e['RawDataType'])
+        self.assertEqual(r.instrument, i)
+        np.testing.assert_array_equal(r.d_var[:], rb.d_var)
+        np.testing.assert_array_equal(r.datetime[:], rb.datetime)
+        np.testing.assert_array_equal(r.inc_angle[:], rb.inc_angle)
+        np.testing.assert_array_equal(r.integration_time[:],
+                                      rb.integration_time)
+        np.testing.assert_array_equal(r.ind_var[:], rb.ind_var)
+
+        # Rows before a line of binary 0's have been written
+        with open(fn, 'wb') as fh:
+            fh.writelines(good * 2 + [zeros])
+        with self.assertRaises(MiniDoasException):
+            d.read(fn, ftype='minidoas-raw', chunksize=50,
+                   type=r.type)
+        self.assertEqual(d.elements['RawData'][-1].d_var.shape, (100, 482))
+        self.assertEqual(len(d.elements['RawDataType']), 1)
+        d.close()
+        os.remove(fn)
+
+    def test_read_tolerant(self):
+        """
+        Test skipping malformed lines in a single pass.
+        """
+        wd = os.path.join(self.data_dir, 'minidoas', 'wind',
+                          '20161214_WD_00.txt')
+        dt = np.dtype([('datetime', 'S19'), ('direction', float)])
+        expected = np.loadtxt(wd, skiprows=1, delimiter='\t', dtype=dt)
+        data, rejected = read_tolerant(wd, dt, delimiter='\t')
+        self.assertEqual(rejected, [])
+        np.testing.assert_array_equal(data, expected)
+
+        with open(wd) as fh:
+            lines = fh.readlines()
+        lines[2] = lines[2].replace('\t', '\t\t')
+        lines[4] = lines[4].split('\t')[0] + '\tn/a\n'
+        lines[6] = '\n'
+        lines[7] = '32/12/2016 00:01:00\t269\n'
+        lines.append('\x00' * 20)
+        fn = tempfile.mktemp()
+        with open(fn, 'w') as fh:
+            fh.writelines(lines)
+
+        def dateconverter(x):
+            return (datetime.datetime.strptime(x, '%d/%m/%Y %H:%M:%S')
+                    .strftime('%Y-%m-%dT%H:%M:%S'))
+
+        data, rejected = read_tolerant(fn, dt, delimiter='\t',
+                                       converters={0: dateconverter})
+        self.assertEqual(rejected, [3, 5, 8, len(lines)])
+        self.assertEqual(data.size, expected.size - 4)
+        self.assertEqual(data['datetime'][0], b'2016-12-14T00:01:00')
+        np.testing.assert_array_equal(data['direction'],
+                                      np.delete(expected['direction'],
+                                                [1, 3, 5, 6]))
+
+        ws = os.path.join(self.data_dir, 'minidoas', 'wind',
+                          '20161214_WS_00.txt')
+        d = Dataset(tempfile.mktemp(), 'w')
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            e = d.read({'direction': fn, 'speed': ws},
+                       ftype='minidoas-wind')
+        self.assertEqual(len(w), 1)
+        self.assertTrue('3, 5, 8' in str(w[0].message))
+        self.assertEqual(e['GasFlowBuffer'].vx.size, expected.size - 4)
+        d.close()
+        os.remove(fn)
+
     def test_missing_entries(self):
         """
         Test on handling missing entries.
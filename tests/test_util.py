@@ -2,7 +2,8 @@ import unittest
 
 import numpy as np
 
-from spectroscopy.util import split_by_scan, _array_multi_sort
+from spectroscopy.util import (split_by_scan, _array_multi_sort, bearing2vec,
+                               vec2bearing, nearest_index)
 
 
 class UtilTestCase(unittest.TestCase):
@@ -60,6 +61,32 @@ class UtilTestCase(unittest.TestCase):
         np.testing.assert_array_equal(out[0], result[0])
         np.testing.assert_array_equal(out[1], result[1])
 
+    def test_bearing2vec(self):
+        bearings = np.array([0., 45., 90., 120., 180., 225., 270., 315.])
+        norms = np.arange(1., 9.)
+        vx, vy = bearing2vec(bearings, norms)
+        for b, n, x, y in zip(bearings, norms, vx, vy):
+            np.testing.assert_array_almost_equal(bearing2vec(b, n), [x, y])
+            self.assertAlmostEqual(vec2bearing(x, y), b)
+        self.assertEqual(bearing2vec(30, 3.0).shape, (2,))
+
+    def test_nearest_index(self):
+        reference = np.array(['2017-05-15T00:00:00', '2017-05-15T00:01:00',
+                              '2017-05-15T00:01:00', '2017-05-15T00:03:00',
+                              '2017-05-15T00:02:00'], dtype='datetime64[s]')
+        values = np.array(['2017-05-15T00:00:01', '2017-05-15T00:00:30',
+                           '2017-05-15T00:01:01', '2017-05-15T00:02:30',
+                           '2017-05-15T00:05:00'], dtype='datetime64[s]')
+        idx, within = nearest_index(values, reference,
+                                    tolerance=np.timedelta64(1, 's'))
+        np.testing.assert_array_equal(idx, [0, 0, 1, 3, 3])
+        np.testing.assert_array_equal(within,
+                                      [True, False, True, False, False])
+        for v, i in zip(values, idx):
+            self.assertEqual(i, np.argmin(np.abs(v - reference)))
+        idx, within = nearest_index(values, reference[:0])
+        self.assertFalse(within.any())
+
 
 def suite():
     return unittest.makeSuite(UtilTestCase, 'test')